@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from core_functions import FAQIndex, load_tenant_configs
+
+
+class Command(BaseCommand):
+    help = "Build or incrementally update the FAQ index from the knowledge base"
+
+    def handle(self, *args, **options):
+        for config in load_tenant_configs():
+            faq = FAQIndex(config.knowledge_manager())
+            changed = faq.load()
+            entries = sum(len(source["entries"]) for source in faq.files.values())
+            self.stdout.write(
+                f"[{config.name}] FAQ index {'updated' if changed else 'up to date'}: "
+                f"{entries} answers from {len(faq.files)} files -> {faq.index_path}"
+            )
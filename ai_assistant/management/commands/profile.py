@@ -0,0 +1,52 @@
+import io
+import os
+import pstats
+import signal
+from urllib.request import Request, urlopen
+from django.core.management.base import BaseCommand, CommandError
+from ai_assistant.profiling import (
+    PROFILE_DIR,
+    handles_signal,
+    profile_synthetic_turn,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile a running bot or worker (--pid with PROFILE_SIGNAL=1, or --url "
+        "with PROFILE_HTTP_PORT), or one synthetic get_response() turn"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pid", type=int, help="Send SIGUSR1 to this process")
+        parser.add_argument("--url", help="e.g. http://127.0.0.1:8765")
+        parser.add_argument("--synthetic", metavar="PROMPT")
+        parser.add_argument("--seconds", type=float, default=30)
+        parser.add_argument("--output", default=PROFILE_DIR)
+
+    def handle(self, *args, **options):
+        if options["synthetic"]:
+            path = profile_synthetic_turn(options["synthetic"], options["output"])
+            self.stdout.write(f"pstats written to {path}")
+            # OutputWrapper ends every write with a newline, pstats writes pieces
+            report = io.StringIO()
+            pstats.Stats(str(path), stream=report).sort_stats(
+                "cumulative"
+            ).print_stats(25)
+            self.stdout.write(report.getvalue())
+        elif options["pid"]:
+            # SIGUSR1 terminates a process that has no handler for it
+            if not handles_signal(options["pid"], signal.SIGUSR1):
+                raise CommandError(
+                    f"Process {options['pid']} does not handle SIGUSR1; start it "
+                    "with PROFILE_SIGNAL=1 or use --url"
+                )
+            # The target samples for its own PROFILE_SECONDS into its PROFILE_DIR
+            os.kill(options["pid"], signal.SIGUSR1)
+            self.stdout.write(f"Profiling requested from process {options['pid']}")
+        elif options["url"]:
+            url = f"{options['url'].rstrip('/')}/profile?seconds={options['seconds']}"
+            with urlopen(Request(url, method="POST")) as response:
+                self.stdout.write(response.read().decode().strip())
+        else:
+            raise CommandError("Pass one of --pid, --url or --synthetic")
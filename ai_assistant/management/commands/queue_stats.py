@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from ai_assistant.views import get_queue_stats
+
+
+class Command(BaseCommand):
+    help = "Show work queue depth, age and per-worker throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--window", type=int, default=60)
+
+    def handle(self, *args, **options):
+        stats = get_queue_stats(window_minutes=options["window"])
+        self.stdout.write(
+            f"pending={stats['pending']} leased={stats['leased']} "
+            f"done={stats['done']} failed={stats['failed']} "
+            f"oldest_pending={stats['oldest_pending_seconds']:.0f}s"
+        )
+        for worker, total in stats["done_per_worker"].items():
+            self.stdout.write(
+                f"{worker:<32} {total:>6} jobs in {stats['window_minutes']} min"
+            )
@@ -0,0 +1,80 @@
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand
+from django.db import connection
+from ai_assistant.profiling import install_profile_triggers
+from ai_assistant.views import claim_job, complete_job, extend_lease, fail_job
+from core_functions import IntegrationLoader
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def heartbeat(job, lease_seconds):
+    """Extend the job's lease while it runs so no other worker reclaims it."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(lease_seconds / 3):
+                if not extend_lease(job, lease_seconds):
+                    logger.warning(f"Lost the lease on job {job.pk}")
+                    return
+        finally:
+            connection.close()  # The thread opened its own DB connection
+
+    thread = threading.Thread(target=beat, name=f"lease-{job.pk}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Command(BaseCommand):
+    help = (
+        "Process queued chat turns; start one per core to share the load and set "
+        "TELEGRAM_SEND_PROCESSES to the number of workers. Knowledge changes are "
+        "uploaded by the bot process, workers only reload their caches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--lease", type=int, default=120)
+        parser.add_argument("--max-attempts", type=int, default=3)
+        parser.add_argument("--poll-interval", type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        install_profile_triggers()
+        # Integrations set up their assistants and watchers on the first job
+        modules = IntegrationLoader().import_integrations()
+        self.stdout.write(f"Worker {worker} started")
+
+        while True:
+            job = claim_job(
+                worker,
+                lease_seconds=options["lease"],
+                max_attempts=options["max_attempts"],
+            )
+            if not job:
+                time.sleep(options["poll_interval"])
+                continue
+
+            # Tenant jobs use integration keys like 'telegram:<tenant>'
+            module = modules.get(job.integration.split(":")[0])
+            if not hasattr(module, "process_job"):
+                fail_job(job, f"No queue handler for {job.integration}", 0)
+                continue
+
+            try:
+                with heartbeat(job, options["lease"]):
+                    module.process_job(job)
+                complete_job(job)
+            except Exception as e:
+                logger.error(f"Job {job.pk} failed: {e}")
+                fail_job(job, e, options["max_attempts"])
@@ -1,5 +1,6 @@
 import logging
 from django.core.management.base import BaseCommand
+from ai_assistant.profiling import install_profile_triggers
 from core_functions import SystemManager
 
 
@@ -8,5 +9,6 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
 
+        install_profile_triggers()
         manager = SystemManager()
         manager.run_system()
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from ai_assistant.views import get_usage_summary
+
+
+class Command(BaseCommand):
+    help = "Show token usage and run time per chat"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=1)
+        parser.add_argument("--integration")
+        parser.add_argument("--chat")
+        parser.add_argument("--limit", type=int, default=20)
+
+    def handle(self, *args, **options):
+        rows = get_usage_summary(
+            days=options["days"],
+            integration=options["integration"],
+            chat_id=options["chat"],
+            limit=options["limit"],
+        )
+        if not rows:
+            self.stdout.write("No usage recorded.")
+            return
+
+        self.stdout.write(
+            f"{'integration':<12} {'chat':<16} {'turns':>6} "
+            f"{'prompt':>10} {'completion':>10} "
+            f"{'run s':>8} {'search':>6}"
+        )
+        for row in rows:
+            self.stdout.write(
+                f"{row['integration']:<12} {row['chat_id']:<16} {row['turns']:>6} "
+                f"{row['prompt_tokens']:>10} {row['completion_tokens']:>10} "
+                f"{row['run_seconds']:>8.1f} {row['file_search_calls']:>6}"
+            )
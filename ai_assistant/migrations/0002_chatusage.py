@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("ai_assistant", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChatUsage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("integration", models.CharField(max_length=50)),
+                ("chat_id", models.CharField(max_length=100)),
+                ("day", models.DateField()),
+                ("turns", models.PositiveIntegerField(default=0)),
+                ("prompt_tokens", models.BigIntegerField(default=0)),
+                ("completion_tokens", models.BigIntegerField(default=0)),
+                ("run_seconds", models.FloatField(default=0)),
+                ("file_search_calls", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "unique_together": {("integration", "chat_id", "day")},
+            },
+        ),
+    ]
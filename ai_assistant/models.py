@@ -15,3 +15,52 @@ class ChatMapping(models.Model):
 
     def __str__(self):
         return f"{self.integration} - {self.chat_id}"
+
+
+class ChatUsage(models.Model):
+    integration = models.CharField(max_length=50)
+    chat_id = models.CharField(max_length=100)
+    day = models.DateField()
+    turns = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    run_seconds = models.FloatField(default=0)
+    file_search_calls = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("integration", "chat_id", "day")
+
+    @property
+    def total_tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def __str__(self):
+        return f"{self.integration} - {self.chat_id} - {self.day}"
+
+
+class Job(models.Model):
+    STATUS_CHOICES = [
+        ("pending", "Pending"),
+        ("leased", "Leased"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+
+    integration = models.CharField(max_length=50)
+    chat_id = models.CharField(max_length=100)
+    prompt = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True, null=True)
+    lease_expires_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="job_status_created_idx")
+        ]
+
+    def __str__(self):
+        return f"{self.integration} - {self.chat_id} - {self.status}"
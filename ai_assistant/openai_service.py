@@ -1,26 +1,179 @@
 import os
-from typing import Optional
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Dict, Optional, Set, Tuple
 from functools import lru_cache
-from core_functions import KnowledgeManager
+from core_functions import FAQIndex, KnowledgeManager
+from django.db import connection
 from openai import OpenAI
 import logging
-from .views import get_chat_mapping, update_chat_mapping
+from .views import (
+    get_chat_mapping,
+    get_tokens_used,
+    record_usage,
+    update_chat_mapping,
+)
 
-client = OpenAI()
+RUN_TIMEOUT = float(os.getenv("OPENAI_RUN_TIMEOUT", "60"))
+# Every API request gets a slice of the run timeout and a single retry, so a
+# hung API fails within seconds and reaches the circuit breaker
+client = OpenAI(
+    timeout=float(os.getenv("OPENAI_REQUEST_TIMEOUT", RUN_TIMEOUT / 4)),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "1")),
+)
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# Usage bookkeeping that needs API calls runs here, off the reply path
+usage_executor = ThreadPoolExecutor(1, thread_name_prefix="openai-usage")
+
+
+class TokenBudgetExceeded(Exception):
+    """Raised when a chat or the whole service used up today's token budget."""
+
+
+class CircuitBreaker:
+    """
+    Trips open when too many of the recent calls failed or were slow, fails
+    fast while open and lets a single probe through after `reset_timeout`
+    seconds (half-open). A successful probe closes the circuit again.
+    """
+
+    def __init__(
+        self,
+        failure_ratio: float = 0.5,
+        window: int = 20,
+        min_calls: int = 5,
+        slow_call_seconds: float = 30.0,
+        reset_timeout: float = 30.0,
+    ):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)  # True for a failed or slow call
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a call may go through right now."""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self, duration: float):
+        if duration >= self.slow_call_seconds:
+            self.record_failure()
+            return
+        with self._lock:
+            if self.state != "closed":
+                logger.info("Circuit closed, OpenAI recovered")
+                self.state = "closed"
+                self._outcomes.clear()
+                self._probing = False
+            self._outcomes.append(False)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == "half_open":
+                self._open()
+                return
+            self._outcomes.append(True)
+            failures = sum(self._outcomes)
+            if (
+                len(self._outcomes) >= self.min_calls
+                and failures / len(self._outcomes) >= self.failure_ratio
+            ):
+                self._open()
+
+    def _open(self):
+        logger.warning("Circuit opened, failing fast on OpenAI calls")
+        self.state = "open"
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._outcomes.clear()
+
 
 class AIAssistant:
-    def __init__(self, api_key: str, model: str = "gpt-4o"):
-        # Set the OpenAI API key and initialize assistant with model
+    def __init__(
+        self,
+        api_key: str,
+        model: str = "gpt-4o",
+        assistant_name: Optional[str] = None,
+        vector_store_name: str = "Online School Statements",
+        knowledge_manager: Optional[KnowledgeManager] = None,
+        owns_knowledge: bool = True,
+    ):
+        # Set the OpenAI API key and initialize assistant with model.
+        # The OpenAI client (and its connection pool) is shared by all tenants.
         client.api_key = api_key
         self.model = model
-        self.knowledge_manager = KnowledgeManager()  # Manage knowledge base
+        self.assistant_name = assistant_name or os.getenv("ASSISTANT_NAME")
+        self.vector_store_name = vector_store_name
+        # Manage knowledge base
+        self.knowledge_manager = knowledge_manager or KnowledgeManager()
         self._assistant_id: Optional[str] = None  # Cache assistant ID
+        # (integration, chat_id) -> (thread_id, run_id) of the run being polled
+        self._active_runs: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._runs_lock = threading.Lock()
+        self._cancelled_runs = set()  # Run ids cancelled by cancel_run()
+        # Turns between run_turn() entry and run creation, and the ones of
+        # them cancel_run() was called for
+        self._turns_in_progress: Set[Tuple[str, str]] = set()
+        self._cancelled_turns: Set[Tuple[str, str]] = set()
+        self._knowledge_lock = threading.Lock()
+        self._knowledge_checked = False
+        # Daily token budgets, 0 disables the limit
+        self.chat_token_budget = int(os.getenv("CHAT_DAILY_TOKEN_BUDGET", "0"))
+        self.global_token_budget = int(os.getenv("DAILY_TOKEN_BUDGET", "0"))
+        self.run_timeout = RUN_TIMEOUT
+        self.upload_timeout = float(os.getenv("KNOWLEDGE_UPLOAD_TIMEOUT", "600"))
+        self.upload_concurrency = int(os.getenv("KNOWLEDGE_UPLOAD_CONCURRENCY", "5"))
+        self.breaker = CircuitBreaker(
+            slow_call_seconds=float(os.getenv("OPENAI_SLOW_CALL_SECONDS", "30")),
+            reset_timeout=float(os.getenv("OPENAI_CIRCUIT_RESET", "30")),
+        )
 
-    @lru_cache(maxsize=1)
+        # Canonical questions are answered locally without starting a run
+        self.faq = FAQIndex(
+            self.knowledge_manager,
+            threshold=float(os.getenv("FAQ_MATCH_THRESHOLD", "0.8")),
+        )
+        self.faq.load()
+
+        # Push file changes instead of hashing the knowledge base per request.
+        # Only the process that owns the knowledge (the intake process) pushes
+        # instructions and uploads the shards; queue workers only drop caches,
+        # so N processes never race on the shards or the vector store.
+        self.owns_knowledge = owns_knowledge
+        self.watcher = self.knowledge_manager.get_watcher()
+        if owns_knowledge:
+            self.watcher.subscribe("instructions", self.reload_instructions)
+            self.watcher.subscribe("knowledge", self.refresh_knowledge)
+        else:
+            self.watcher.subscribe(
+                "instructions", KnowledgeManager.load_instructions.cache_clear
+            )
+            self.watcher.subscribe("knowledge", self.knowledge_manager.clear_caches)
+        self.watcher.subscribe("instructions", self.faq.rebuild)
+        self.watcher.subscribe("knowledge", self.faq.rebuild)
+
+    @lru_cache(maxsize=None)  # One entry per tenant's assistant
     def get_assistant_id(self) -> str:
         """Cache and retrieve assistant ID."""
         if self._assistant_id:
@@ -53,7 +206,7 @@ class AIAssistant:
 
         # Access the assistants' list from the returned object
         for assistant in assistants.data:
-            if assistant.name == os.getenv("ASSISTANT_NAME"):
+            if assistant.name == self.assistant_name:
                 self._assistant_id = assistant.id
                 new_instructions = self.knowledge_manager.load_instructions()
                 assistant = client.beta.assistants.update(
@@ -65,7 +218,7 @@ class AIAssistant:
         # If assistant doesn't exist, create a new one using the beta API
         try:
             assistant = client.beta.assistants.create(
-                name=os.getenv("ASSISTANT_NAME"),
+                name=self.assistant_name,
                 instructions=self.knowledge_manager.load_instructions(),
                 model="gpt-4o",
                 tools=[{"type": "file_search"}],  # Define tools like file search
@@ -80,56 +233,72 @@ class AIAssistant:
 
     def get_response(self, integration, chat_id, prompt: str) -> str:
         """Get AI response to the given prompt."""
-        assistant_id = self.get_assistant_id()  # Retrieve the assistant ID
-
-        # Check and update knowledge base if necessary
-        if self.knowledge_manager.check_and_update_knowledge():
-            logger.info("Knowledge base update detected, updating knowledge.")
-            print("Updating knowledge in vector store")
-
-            try:
-                vector_stores = client.beta.vector_stores.list()
-                existing_store = None
+        answer = self.faq.match(prompt)
+        if answer:
+            logger.info(f"Answered chat {chat_id} from the FAQ index")
+            return answer
 
-                for store in vector_stores.data:
-                    if store.name == "Online School Statements":
-                        existing_store = store
-                        break
+        self.check_budget(integration, chat_id)
+        if not self.breaker.allow():
+            logger.warning("Circuit open, answering from the local knowledge base")
+            return self.fallback_response(prompt)
 
-                if existing_store:
-                    vector_store_id = existing_store.id
-                else:
-                    vector_store = client.beta.vector_stores.create(
-                        name="Online School Statements"
-                    )
-                    vector_store_id = vector_store.id
-
-                existing_files = client.beta.vector_stores.files.list(
-                    vector_store_id=vector_store_id
-                )
+        # Uploads can take minutes, so they stay out of the breaker's timing
+        self.sync_knowledge()
+        started = time.monotonic()
+        try:
+            response = self.run_turn(integration, chat_id, prompt)
+        except Exception as e:
+            logger.error(f"Error getting response from OpenAI: {e}")
+            self.breaker.record_failure()
+            return self.fallback_response(prompt)
+        self.breaker.record_success(time.monotonic() - started)
+        return response
 
-                for file in existing_files.data:
-                    client.beta.vector_stores.files.delete(
-                        vector_store_id=vector_store_id, file_id=file.id
-                    )
+    def sync_knowledge(self):
+        """Upload knowledge changes before a turn; on failure keep the old store."""
+        # Once the watcher runs, changes are pushed; otherwise hash per request
+        if not self.owns_knowledge or (
+            self.watcher.is_running() and self._knowledge_checked
+        ):
+            return
+        try:
+            self.refresh_knowledge()
+            self._knowledge_checked = True
+        except Exception as e:
+            logger.error(f"Knowledge sync failed, keeping the current store: {e}")
 
-                file_paths = ["ai_assistant/knowledge_base.txt"]
-                file_streams = [open(path, "rb") for path in file_paths]
+    def fallback_response(self, prompt: str) -> str:
+        """Answer from a local keyword search while OpenAI is unavailable."""
+        try:
+            matches = self.knowledge_manager.search(prompt)
+        except Exception as e:
+            logger.error(f"Local knowledge search failed: {e}")
+            matches = []
 
-                file_batch = client.beta.vector_stores.file_batches.upload_and_poll(
-                    vector_store_id=vector_store_id, files=file_streams
-                )
+        if not matches:
+            return "The assistant is temporarily unavailable, please try again later."
+        return (
+            "The assistant is temporarily unavailable. "
+            "Here is what I found in the course materials:\n\n" + "\n\n".join(matches)
+        )
 
-                assistant = client.beta.assistants.update(
-                    assistant_id=assistant_id,
-                    tool_resources={
-                        "file_search": {"vector_store_ids": [vector_store_id]}
-                    },
-                )
+    def run_turn(self, integration, chat_id, prompt: str) -> Optional[str]:
+        """Send the prompt to the assistant thread of the chat and wait for the run."""
+        run_key = (integration, str(chat_id))
+        with self._runs_lock:
+            self._turns_in_progress.add(run_key)
+            self._cancelled_turns.discard(run_key)
+        try:
+            return self._run_turn(run_key, prompt)
+        finally:
+            with self._runs_lock:
+                self._turns_in_progress.discard(run_key)
+                self._cancelled_turns.discard(run_key)
 
-            except Exception as e:
-                logger.error(f"Error managing vector store: {e}")
-                raise
+    def _run_turn(self, run_key: Tuple[str, str], prompt: str) -> Optional[str]:
+        integration, chat_id = run_key
+        assistant_id = self.get_assistant_id()  # Retrieve the assistant ID
         assistant = client.beta.assistants.retrieve(assistant_id=assistant_id)
 
         # Create a new thread for interaction with the assistant
@@ -160,12 +329,222 @@ class AIAssistant:
             + "do NOT add the link or mention the knowledge_base.txt file in the answer",
         )
 
-        run = client.beta.threads.runs.create_and_poll(
+        with self._runs_lock:
+            if run_key in self._cancelled_turns:
+                logger.info(f"Turn for chat {chat_id} was cancelled before its run")
+                return None
+        started = time.monotonic()
+        run = client.beta.threads.runs.create(
             thread_id=thread_id, assistant_id=assistant.id
         )
+        with self._runs_lock:
+            self._active_runs[run_key] = (thread_id, run.id)
+            cancelled = run_key in self._cancelled_turns
+        if cancelled:
+            # cancel_run() arrived while the run was being created
+            self.cancel_run(integration, chat_id)
+        try:
+            run = self.wait_for_run(run, started + self.run_timeout)
+        finally:
+            with self._runs_lock:
+                if self._active_runs.get(run_key) == (thread_id, run.id):
+                    del self._active_runs[run_key]
+        self.record_run_usage(integration, chat_id, run, time.monotonic() - started)
+
+        if run.status == "cancelled":
+            with self._runs_lock:
+                superseded = run.id in self._cancelled_runs
+                self._cancelled_runs.discard(run.id)
+            if superseded:
+                logger.info(f"Run {run.id} was cancelled by a newer message")
+                return None
+        if run.status != "completed":
+            # failed/expired/incomplete runs mean the API is degraded
+            raise RuntimeError(f"Run {run.id} finished with status {run.status}")
 
         messages = list(
             client.beta.threads.messages.list(thread_id=thread_id, run_id=run.id)
         )
         messages_content = messages[0].content[0].text
-        return messages_content
+        return messages_content.value
+
+    def wait_for_run(self, run, deadline: float):
+        """Poll a run until it finishes; cancel it and raise once past the deadline."""
+        while run.status in ("queued", "in_progress", "cancelling"):
+            if time.monotonic() > deadline:
+                try:
+                    client.beta.threads.runs.cancel(
+                        run_id=run.id, thread_id=run.thread_id
+                    )
+                except Exception as e:
+                    logger.warning(f"Could not cancel run {run.id}: {e}")
+                raise TimeoutError(f"Run {run.id} did not finish in time")
+            time.sleep(0.5)
+            run = client.beta.threads.runs.retrieve(
+                run_id=run.id, thread_id=run.thread_id
+            )
+        return run
+
+    def check_budget(self, integration, chat_id):
+        """Throttle chats (or everyone) once today's token budget is spent."""
+        if self.chat_token_budget and (
+            get_tokens_used(integration=integration, chat_id=chat_id)
+            >= self.chat_token_budget
+        ):
+            raise TokenBudgetExceeded(f"Daily token budget exhausted for {chat_id}")
+        if self.global_token_budget and get_tokens_used() >= self.global_token_budget:
+            raise TokenBudgetExceeded("Daily token budget exhausted")
+
+    def record_run_usage(self, integration, chat_id, run, run_seconds: float):
+        """
+        Store token usage and duration of a finished run. Its file_search
+        calls need another API request and are counted in the background.
+        """
+        usage = getattr(run, "usage", None)
+        try:
+            record_usage(
+                integration=integration,
+                chat_id=chat_id,
+                prompt_tokens=usage.prompt_tokens if usage else 0,
+                completion_tokens=usage.completion_tokens if usage else 0,
+                run_seconds=run_seconds,
+            )
+        except Exception as e:
+            logger.error(f"Error recording usage for run {run.id}: {e}")
+        usage_executor.submit(
+            self.record_file_search_calls, integration, chat_id, run, client
+        )
+
+    def record_file_search_calls(self, integration, chat_id, run, api):
+        """Add the file_search calls of a run made through `api` to the usage."""
+        try:
+            steps = api.beta.threads.runs.steps.list(
+                thread_id=run.thread_id, run_id=run.id
+            )
+            file_search_calls = 0
+            for step in steps.data:
+                for tool_call in getattr(step.step_details, "tool_calls", None) or []:
+                    if tool_call.type == "file_search":
+                        file_search_calls += 1
+            if file_search_calls:
+                record_usage(
+                    integration=integration,
+                    chat_id=chat_id,
+                    file_search_calls=file_search_calls,
+                    turns=0,
+                )
+        except Exception as e:
+            logger.warning(f"Could not count file_search calls of run {run.id}: {e}")
+        finally:
+            connection.close()  # The pool thread opened its own DB connection
+
+    def reload_instructions(self):
+        """Drop cached instructions and push the new ones to the assistant."""
+        KnowledgeManager.load_instructions.cache_clear()
+        AIAssistant.get_assistant_id.cache_clear()
+        self.get_assistant_id()
+
+    def refresh_knowledge(self, assistant_id: Optional[str] = None) -> bool:
+        """Re-upload the knowledge base to the vector store if it changed."""
+        with self._knowledge_lock:
+            folder_hash = self.knowledge_manager.knowledge_changed()
+            if folder_hash is None:
+                return False
+            self.knowledge_manager.clear_caches()
+            shards = self.knowledge_manager.load_knowledge_base()
+            if not self.watcher.is_running():
+                self.faq.rebuild()
+
+            logger.info("Knowledge base update detected, updating knowledge.")
+            print("Updating knowledge in vector store")
+            assistant_id = assistant_id or self.get_assistant_id()
+
+            try:
+                vector_stores = client.beta.vector_stores.list()
+                existing_store = None
+
+                for store in vector_stores:  # Walks every page
+                    if store.name == self.vector_store_name:
+                        existing_store = store
+                        break
+
+                if existing_store:
+                    vector_store_id = existing_store.id
+                else:
+                    vector_store = client.beta.vector_stores.create(
+                        name=self.vector_store_name
+                    )
+                    vector_store_id = vector_store.id
+
+                # Iterating the page fetches every page, not only the first 20
+                existing_file_ids = [
+                    file.id
+                    for file in client.beta.vector_stores.files.list(
+                        vector_store_id=vector_store_id
+                    )
+                ]
+
+                for file_id in existing_file_ids:
+                    client.beta.vector_stores.files.delete(
+                        vector_store_id=vector_store_id, file_id=file_id
+                    )
+                    # Detaching keeps the uploaded file, so delete it as well
+                    try:
+                        client.files.delete(file_id)
+                    except Exception as e:
+                        logger.warning(f"Could not delete file {file_id}: {e}")
+
+                if shards:
+                    with ExitStack() as stack:
+                        file_streams = [
+                            stack.enter_context(open(path, "rb")) for path in shards
+                        ]
+                        # Shards upload concurrently under a longer timeout and
+                        # are ingested as one batch
+                        uploader = client.with_options(timeout=self.upload_timeout)
+                        uploader.beta.vector_stores.file_batches.upload_and_poll(
+                            vector_store_id=vector_store_id,
+                            files=file_streams,
+                            max_concurrency=self.upload_concurrency,
+                        )
+                else:
+                    logger.warning("No knowledge shards to upload")
+
+                assistant = client.beta.assistants.update(
+                    assistant_id=assistant_id,
+                    tool_resources={
+                        "file_search": {"vector_store_ids": [vector_store_id]}
+                    },
+                )
+
+            except Exception as e:
+                logger.error(f"Error managing vector store: {e}")
+                raise
+            # Only now, so a failed upload is retried on the next sync
+            self.knowledge_manager.mark_knowledge_synced(folder_hash)
+            return True
+
+    def cancel_run(self, integration, chat_id) -> bool:
+        """
+        Cancel the run currently being polled for the chat, if any. A turn
+        that has not created its run yet is flagged so it never starts one.
+        """
+        run_key = (integration, str(chat_id))
+        with self._runs_lock:
+            active = self._active_runs.get(run_key)
+            if not active and run_key in self._turns_in_progress:
+                self._cancelled_turns.add(run_key)
+                return True
+        if not active:
+            return False
+
+        thread_id, run_id = active
+        with self._runs_lock:
+            self._cancelled_runs.add(run_id)
+        try:
+            client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id)
+            logger.info(f"Cancelled run {run_id} for chat {chat_id}")
+            return True
+        except Exception as e:
+            logger.warning(f"Could not cancel run {run_id}: {e}")
+            return False
@@ -0,0 +1,249 @@
+import cProfile
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+
+class StackSampler:
+    """
+    Samples the stacks of all threads every `interval` seconds. Samples are
+    grouped by the integration whose module is on the stack ("core" when
+    none is) and counted as collapsed stacks for flame graph tools.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+
+    @staticmethod
+    def collapse(frame):
+        integration = "core"
+        names = []
+        while frame is not None:
+            path = Path(frame.f_code.co_filename)
+            if path.parent.name == "integrations":
+                integration = path.stem
+            names.append(f"{path.name}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return integration, ";".join(reversed(names))
+
+    def run(self, seconds: float) -> Dict[str, Counter]:
+        samples: Dict[str, Counter] = defaultdict(Counter)
+        own_thread = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                integration, stack = self.collapse(frame)
+                samples[integration][stack] += 1
+            time.sleep(self.interval)
+        return samples
+
+
+def write_collapsed(samples: Dict[str, Counter], output_dir: str = PROFILE_DIR):
+    """Write one collapsed-stack file per integration and return the paths."""
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    paths = []
+    for integration, stacks in samples.items():
+        path = output / f"{integration}-{os.getpid()}-{stamp}.collapsed"
+        path.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in stacks.most_common()),
+            encoding="utf-8",
+        )
+        paths.append(path)
+    return paths
+
+
+_profiling = threading.Lock()
+
+
+def start_profile(seconds: float, output_dir: str = PROFILE_DIR) -> bool:
+    """Sample this process in the background; False if a profile is running."""
+    if not _profiling.acquire(blocking=False):
+        return False
+
+    def capture():
+        try:
+            paths = write_collapsed(StackSampler().run(seconds), output_dir)
+            logger.info(f"Profile written: {', '.join(map(str, paths))}")
+        finally:
+            _profiling.release()
+
+    threading.Thread(target=capture, name="profiler", daemon=True).start()
+    return True
+
+
+def handles_signal(pid: int, signum: int) -> Optional[bool]:
+    """Whether the process has a handler for signum; None if /proc is missing."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as status:
+            for line in status:
+                if line.startswith("SigCgt:"):
+                    return bool(int(line.split()[1], 16) >> (signum - 1) & 1)
+    except OSError:
+        return None
+    return None
+
+
+class ProfileRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        query = parse_qs(urlparse(self.path).query)
+        seconds = float(query.get("seconds", ["30"])[0])
+        started = start_profile(seconds)
+        self.send_response(202 if started else 409)
+        self.end_headers()
+        self.wfile.write(
+            b"profiling started\n" if started else b"profile already running\n"
+        )
+
+
+def install_profile_triggers():
+    """
+    Opt-in triggers for profiling a live process: PROFILE_SIGNAL=1 samples
+    for PROFILE_SECONDS on SIGUSR1, PROFILE_HTTP_PORT serves
+    POST /profile?seconds=N on localhost. Must run in the main thread.
+    """
+    if os.getenv("PROFILE_SIGNAL", "0") == "1" and hasattr(signal, "SIGUSR1"):
+        seconds = float(os.getenv("PROFILE_SECONDS", "30"))
+        signal.signal(signal.SIGUSR1, lambda signum, frame: start_profile(seconds))
+        logger.info(f"Profiling on SIGUSR1 enabled for pid {os.getpid()}")
+
+    port = os.getenv("PROFILE_HTTP_PORT")
+    if port:
+        server = ThreadingHTTPServer(("127.0.0.1", int(port)), ProfileRequestHandler)
+        threading.Thread(
+            target=server.serve_forever, name="profile-http", daemon=True
+        ).start()
+        logger.info(f"Profiling over HTTP enabled on 127.0.0.1:{port}")
+
+
+class FakeOpenAI:
+    """
+    In-process stand-in for the parts of the OpenAI client AIAssistant uses.
+    Every call returns immediately, so a profiled turn shows only local work.
+    """
+
+    def __init__(self):
+        self.api_key = "fake"
+        self.with_options = lambda **kw: self
+        self._messages: Dict[str, List] = defaultdict(list)
+        ns = SimpleNamespace
+        self.files = ns(delete=lambda file_id, **kw: None)
+        self.beta = ns(
+            assistants=ns(
+                list=lambda **kw: ns(data=[]),
+                create=lambda **kw: ns(id="asst_fake", name=kw.get("name")),
+                update=lambda assistant_id, **kw: ns(id=assistant_id),
+                retrieve=lambda assistant_id, **kw: ns(id=assistant_id),
+            ),
+            vector_stores=ns(
+                list=lambda **kw: [],
+                create=lambda **kw: ns(id="vs_fake", name=kw.get("name")),
+                files=ns(
+                    list=lambda **kw: [],
+                    delete=lambda **kw: None,
+                ),
+                file_batches=ns(upload_and_poll=self._upload),
+            ),
+            threads=ns(
+                create=lambda **kw: ns(id=f"thread_{uuid.uuid4().hex}"),
+                messages=ns(create=self._add_message, list=self._list_messages),
+                runs=ns(
+                    create=self._create_run,
+                    retrieve=self._create_run,
+                    cancel=lambda **kw: None,
+                    steps=ns(list=lambda **kw: ns(data=[])),
+                ),
+            ),
+        )
+
+    @staticmethod
+    def _upload(vector_store_id, files, **kw):
+        for stream in files:
+            stream.read()
+            stream.close()
+        return SimpleNamespace(status="completed")
+
+    def _add_message(self, thread_id, role, content, **kw):
+        self._messages[thread_id].append(content)
+
+    def _list_messages(self, thread_id, **kw):
+        prompt = self._messages[thread_id][-1] if self._messages[thread_id] else ""
+        text = SimpleNamespace(value=f"Synthetic answer ({len(prompt)} chars asked)")
+        return [SimpleNamespace(content=[SimpleNamespace(text=text)])]
+
+    @staticmethod
+    def _create_run(thread_id, **kw):
+        return SimpleNamespace(
+            id=kw.get("run_id", "run_fake"),
+            thread_id=thread_id,
+            status="completed",
+            usage=SimpleNamespace(prompt_tokens=0, completion_tokens=0),
+        )
+
+
+def profile_synthetic_turn(prompt: str, output_dir: str = PROFILE_DIR):
+    """
+    cProfile one get_response() turn against FakeOpenAI; returns the pstats
+    path. The turn runs on a temporary copy of the instructions and knowledge
+    base so the real .hash and shards stay untouched, and its database writes
+    are rolled back.
+    """
+    from django.db import transaction
+    from ai_assistant import openai_service
+    from core_functions import KnowledgeManager
+
+    real_client = openai_service.client
+    openai_service.client = FakeOpenAI()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            source = KnowledgeManager()
+            if source.instructions_file.exists():
+                shutil.copy(source.instructions_file, Path(workdir))
+            if source.knowledge_path.exists():
+                shutil.copytree(
+                    source.knowledge_path,
+                    Path(workdir) / "knowledge_base",
+                    ignore=shutil.ignore_patterns(".*"),
+                )
+
+            assistant = openai_service.AIAssistant(
+                api_key="fake", knowledge_manager=KnowledgeManager(workdir)
+            )
+            profiler = cProfile.Profile()
+            with transaction.atomic():
+                profiler.enable()
+                answer = assistant.get_response(
+                    integration="profile", chat_id="synthetic", prompt=prompt
+                )
+                profiler.disable()
+                # Keep the synthetic ChatMapping/ChatUsage rows out of the tables
+                transaction.set_rollback(True)
+    finally:
+        openai_service.client = real_client
+
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+    path = output / f"synthetic-{time.strftime('%Y%m%d-%H%M%S')}.pstats"
+    profiler.dump_stats(str(path))
+    logger.info(f"Synthetic turn answered: {json.dumps(answer)[:100]}")
+    return path
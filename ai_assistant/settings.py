@@ -53,6 +53,8 @@ MIDDLEWARE = [
 ]
 
 
+ROOT_URLCONF = "config.urls"
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -77,6 +79,8 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # Worker processes share the queue tables, wait for locks instead of failing
+        "OPTIONS": {"timeout": 20},
     }
 }
 
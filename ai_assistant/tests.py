@@ -1,3 +1,634 @@
-from django.test import TestCase
+import io
+import os
+import signal
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import skipIf
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from ai_assistant import openai_service
+from ai_assistant.openai_service import CircuitBreaker
+from ai_assistant.models import ChatUsage, Job
+from ai_assistant.profiling import FakeOpenAI, handles_signal
+from ai_assistant.views import claim_job, enqueue_job, get_tokens_used, record_usage
+from core_functions import (
+    DocumentStore,
+    FairLimiter,
+    FAQIndex,
+    KnowledgeManager,
+    KnowledgeWatcher,
+    MessageCoalescer,
+    Observer,
+    ShardWriter,
+)
+from integrations.telegram import OutboundOp, SendQueue, TokenBucket, split_message
+
+
+class RecordingBot:
+    """Bot double that accepts every send and remembers it."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text))
+        return SimpleNamespace(message_id=len(self.sent))
+
+    def delete_message(self, chat_id, message_id):
+        pass
+
+
+def send_op(chat_id, text):
+    return OutboundOp("send", chat_id, text=text)
+
+
+class SplitMessageTests(SimpleTestCase):
+    def test_short_text_is_one_chunk(self):
+        self.assertEqual(split_message("hello"), ["hello"])
+
+    def test_splits_at_paragraph_break(self):
+        text = "a" * 30 + "\n\n" + "b" * 30
+        self.assertEqual(split_message(text, limit=40), ["a" * 30, "b" * 30])
+
+    def test_chunks_stay_under_limit(self):
+        text = " ".join(["word"] * 500)
+        chunks = split_message(text, limit=100)
+        self.assertTrue(all(len(chunk) <= 100 for chunk in chunks))
+        self.assertEqual(" ".join(chunks), text)
+
+    def test_text_without_breaks_is_cut_at_limit(self):
+        self.assertEqual(split_message("x" * 25, limit=10), ["x" * 10] * 2 + ["x" * 5])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_delay_after_capacity_is_used(self):
+        bucket = TokenBucket(rate=2, capacity=1)
+        now = bucket.updated
+        self.assertEqual(bucket.delay(now), 0)
+        bucket.take(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.5)
+        self.assertEqual(bucket.delay(now + 0.5), 0)
+
+
+class SendQueueTests(SimpleTestCase):
+    def setUp(self):
+        self.queue = SendQueue(RecordingBot(), global_rate=30, chat_rate=1)
+
+    def test_chats_are_served_round_robin(self):
+        queue = self.queue
+        # Holding the condition keeps the dispatcher thread out
+        with queue._cond:
+            first = queue._enqueue(send_op("a", "1"))
+            queue._enqueue(send_op("a", "2"))
+            other = queue._enqueue(send_op("b", "1"))
+
+            self.assertEqual(queue._next_op(), (first, None))
+            # Chat "a" is busy with its first message, so "b" goes next
+            self.assertEqual(queue._next_op(), (other, None))
+
+            queue._busy.clear()
+            op, wait = queue._next_op()
+            self.assertIsNone(op)
+            self.assertGreater(wait, 0)  # Chat "a" waits for its 1/s bucket
+
+    def test_blocked_chat_waits_for_retry_after(self):
+        queue = self.queue
+        with queue._cond:
+            queue._enqueue(send_op("a", "1"))
+            queue._blocked_until["a"] = time.monotonic() + 5
+            op, wait = queue._next_op()
+        self.assertIsNone(op)
+        self.assertAlmostEqual(wait, 5, delta=0.5)
+
+
+class MessageCoalescerTests(SimpleTestCase):
+    def coalescer(self, on_flush, cancelled):
+        # A long window keeps the timers out; the tests flush by hand
+        coalescer = MessageCoalescer(on_flush, cancelled.append, window=60)
+        self.addCleanup(self.cancel_timers, coalescer)
+        return coalescer
+
+    @staticmethod
+    def cancel_timers(coalescer):
+        for timer in coalescer._timers.values():
+            timer.cancel()
+
+    def test_message_during_turn_folds_it_and_cancels(self):
+        prompts, cancelled = [], []
+
+        def on_flush(chat_id, prompt, generation):
+            prompts.append(prompt)
+            coalescer.add(chat_id, "second")  # Arrives while the turn runs
+            self.assertFalse(coalescer.commit(chat_id, generation))
+
+        coalescer = self.coalescer(on_flush, cancelled)
+        coalescer.add("1", "first")
+        coalescer._flush("1")
+
+        self.assertEqual(prompts, ["first"])
+        self.assertEqual(cancelled, ["1"])
+        self.assertEqual(coalescer._pending["1"], ["first", "second"])
+
+    def test_message_after_commit_starts_a_new_turn(self):
+        cancelled = []
+
+        def on_flush(chat_id, prompt, generation):
+            self.assertTrue(coalescer.commit(chat_id, generation))
+            coalescer.add(chat_id, "thanks")  # Arrives after the reply was sent
+
+        coalescer = self.coalescer(on_flush, cancelled)
+        coalescer.add("1", "question")
+        coalescer._flush("1")
+
+        self.assertEqual(cancelled, [])
+        self.assertEqual(coalescer._pending["1"], ["thanks"])
+
+
+class CancelRunTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.fake = FakeOpenAI()
+        real_client = openai_service.client
+        openai_service.client = self.fake
+        self.addCleanup(setattr, openai_service, "client", real_client)
+        self.assistant = openai_service.AIAssistant(
+            api_key="fake", knowledge_manager=KnowledgeManager(self.workdir.name)
+        )
+
+    def test_cancel_before_the_run_is_created_skips_it(self):
+        runs = []
+        threads = self.fake.beta.threads
+
+        def add_message(**kw):
+            # A newer message supersedes the turn while it is being set up
+            self.assertTrue(self.assistant.cancel_run("telegram", 1))
+
+        threads.messages.create = add_message
+        threads.runs.create = lambda **kw: runs.append(kw)
+
+        self.assertIsNone(self.assistant.run_turn("telegram", 1, "question"))
+        self.assertEqual(runs, [])
+
+    def test_cancel_without_a_turn_in_progress_is_a_no_op(self):
+        self.assertFalse(self.assistant.cancel_run("telegram", 1))
+        self.assertIsNotNone(self.assistant.run_turn("telegram", 1, "question"))
+
+
+@skipIf(Observer is None, "watchdog is not installed")
+class KnowledgeWatcherTests(SimpleTestCase):
+    def test_reading_watched_files_does_not_retrigger(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            instructions = Path(workdir) / "instructions.txt"
+            instructions.write_text("v1", encoding="utf-8")
+            (Path(workdir) / "knowledge_base").mkdir()
+
+            fired = []
+
+            def reload():
+                # Subscribers read what they watch, like load_instructions()
+                instructions.read_text(encoding="utf-8")
+                fired.append(time.monotonic())
+
+            watcher = KnowledgeWatcher(workdir, debounce=0.1)
+            watcher.subscribe("instructions", reload)
+            watcher.start()
+            self.addCleanup(watcher.stop)
+            self.assertIsNotNone(watcher._observer)
+
+            instructions.write_text("v2", encoding="utf-8")
+            deadline = time.monotonic() + 5
+            while not fired and time.monotonic() < deadline:
+                time.sleep(0.05)
+            time.sleep(1)
+
+        self.assertEqual(len(fired), 1)
+
+
+class DocumentStoreTests(SimpleTestCase):
+    def test_duplicates_are_counted_once(self):
+        store = DocumentStore(keep_text=False)
+        self.assertEqual(store.add_document("a.txt", ["Hello  world", "Bye"]), 2)
+        self.assertEqual(store.add_document("b.txt", ["hello world", "New"]), 1)
+
+        stats = store.stats()
+        self.assertEqual(stats["chunks"], 3)
+        self.assertEqual(stats["duplicates"], 1)
+        self.assertEqual(stats["bytes_saved"], len("hello world"))
+        self.assertEqual(store.chunks, {})  # Hash-only mode keeps no text
+
+    def test_compiled_shards_hold_each_chunk_once(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            knowledge = Path(workdir) / "knowledge_base"
+            knowledge.mkdir()
+            (knowledge / "a.txt").write_text("Intro\n\nBoilerplate", encoding="utf-8")
+            (knowledge / "b.txt").write_text("Boilerplate\n\nMore", encoding="utf-8")
+            manager = KnowledgeManager(workdir)
+
+            shards = manager.load_knowledge_base()
+            text = "".join(path.read_text(encoding="utf-8") for path in shards)
+
+        self.assertEqual(text.count("Boilerplate"), 1)
+        self.assertEqual(manager.knowledge_stats["duplicates"], 1)
+        self.assertEqual(manager.knowledge_stats["documents"], 2)
+
+
+class UsageMetricsTests(TestCase):
+    def setUp(self):
+        record_usage("telegram", "1", prompt_tokens=100, completion_tokens=20)
+        record_usage("telegram", "1", prompt_tokens=50, completion_tokens=5)
+        record_usage("telegram", "2", prompt_tokens=10, completion_tokens=1)
+
+    def test_tokens_are_summed_per_chat_and_day(self):
+        self.assertEqual(get_tokens_used(integration="telegram", chat_id="1"), 175)
+        self.assertEqual(get_tokens_used(), 186)
+
+    def test_metrics_require_a_staff_user(self):
+        for url in ("/ai/metrics/usage/", "/ai/metrics/queue/"):
+            self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_usage_metrics(self):
+        staff = User.objects.create_user("admin", is_staff=True)
+        self.client.force_login(staff)
+
+        response = self.client.get("/ai/metrics/usage/", {"days": 7})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["turns"], 3)
+        self.assertEqual(response.json()["prompt_tokens"], 160)
+
+        response = self.client.get("/ai/metrics/usage/", {"days": "0"})
+        self.assertEqual(response.status_code, 400)
+
+
+class RecordRunUsageTests(TransactionTestCase):
+    def test_file_search_calls_are_counted_in_the_background(self):
+        fake = FakeOpenAI()
+        real_client = openai_service.client
+        openai_service.client = fake
+        self.addCleanup(setattr, openai_service, "client", real_client)
+        step = SimpleNamespace(
+            step_details=SimpleNamespace(
+                tool_calls=[SimpleNamespace(type="file_search")]
+            )
+        )
+        fake.beta.threads.runs.steps.list = lambda **kw: SimpleNamespace(data=[step])
+        with tempfile.TemporaryDirectory() as workdir:
+            assistant = openai_service.AIAssistant(
+                api_key="fake", knowledge_manager=KnowledgeManager(workdir)
+            )
+        run = fake.beta.threads.runs.create(thread_id="thread")
+        run.usage = SimpleNamespace(prompt_tokens=30, completion_tokens=5)
+
+        assistant.record_run_usage("telegram", "1", run, 2.0)
+        usage = ChatUsage.objects.get(integration="telegram", chat_id="1")
+        self.assertEqual((usage.turns, usage.prompt_tokens), (1, 30))
+
+        openai_service.usage_executor.submit(lambda: None).result()  # Drain
+        usage.refresh_from_db()
+        self.assertEqual((usage.turns, usage.file_search_calls), (1, 1))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_after_failure_ratio(self):
+        breaker = CircuitBreaker(failure_ratio=0.5, min_calls=4, reset_timeout=60)
+        breaker.record_success(0.1)
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker(min_calls=2, slow_call_seconds=1)
+        breaker.record_success(5)
+        breaker.record_success(5)
+        self.assertEqual(breaker.state, "open")
+
+    def test_half_open_lets_one_probe_through(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, "half_open")
+        self.assertFalse(breaker.allow())
+
+        breaker.record_success(0.1)
+        self.assertEqual(breaker.state, "closed")
+        self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = CircuitBreaker(min_calls=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.allow()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+
+
+class BreakerTimingTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        real_client = openai_service.client
+        openai_service.client = FakeOpenAI()
+        self.addCleanup(setattr, openai_service, "client", real_client)
+        self.assistant = openai_service.AIAssistant(
+            api_key="fake", knowledge_manager=KnowledgeManager(self.workdir.name)
+        )
+
+    def test_knowledge_sync_is_not_timed_by_the_breaker(self):
+        def slow_upload(assistant_id=None):
+            time.sleep(0.2)
+            return True
+
+        self.assistant.refresh_knowledge = slow_upload
+        self.assistant.breaker.slow_call_seconds = 0.1
+
+        answer = self.assistant.get_response("telegram", 1, "question")
+        self.assertTrue(answer.startswith("Synthetic answer"))
+        self.assertEqual(list(self.assistant.breaker._outcomes), [False])
+
+    def test_failed_knowledge_sync_still_answers(self):
+        def failing_upload(assistant_id=None):
+            raise RuntimeError("upload failed")
+
+        self.assistant.refresh_knowledge = failing_upload
+
+        answer = self.assistant.get_response("telegram", 1, "question")
+        self.assertTrue(answer.startswith("Synthetic answer"))
+        self.assertEqual(self.assistant.breaker.state, "closed")
+
+
+class FAQIndexTests(SimpleTestCase):
+    FAQ = (
+        "=== faq.txt ===\n"
+        "Q: What are the opening hours?\n"
+        "Question: When is the school open?\n"
+        "A: Monday to Friday, 9:00 to 18:00.\n"
+        "Saturdays on request.\n"
+        "Вопрос: Сколько стоит обучение?\n"
+        "Ответ: 100 евро в месяц.\n"
+    )
+
+    def test_parse_text_groups_question_variants(self):
+        entries = FAQIndex.parse_text(self.FAQ)
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(
+            entries[0]["questions"],
+            ["What are the opening hours?", "When is the school open?"],
+        )
+        self.assertEqual(
+            entries[0]["answer"],
+            "Monday to Friday, 9:00 to 18:00.\nSaturdays on request.",
+        )
+        self.assertEqual(entries[1]["answer"], "100 евро в месяц.")
+
+    def test_question_without_answer_is_skipped(self):
+        self.assertEqual(FAQIndex.parse_text("Q: Anyone there?\nJust a note."), [])
+
+    def test_match(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            knowledge = Path(workdir) / "knowledge_base"
+            knowledge.mkdir()
+            (knowledge / "faq.txt").write_text(self.FAQ, encoding="utf-8")
+            faq = FAQIndex(KnowledgeManager(workdir))
+            self.assertTrue(faq.rebuild())
+
+            self.assertEqual(
+                faq.match("when is the school open"),
+                "Monday to Friday, 9:00 to 18:00.\nSaturdays on request.",
+            )
+            self.assertEqual(faq.match("Сколько стоит обучение?"), "100 евро в месяц.")
+            self.assertIsNone(faq.match("Can I bring my dog to class?"))
+            self.assertFalse(faq.rebuild())  # Nothing changed since
+
+    def test_load_picks_up_edits_made_while_stopped(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            knowledge = Path(workdir) / "knowledge_base"
+            knowledge.mkdir()
+            faq_file = knowledge / "faq.txt"
+            faq_file.write_text(self.FAQ, encoding="utf-8")
+            FAQIndex(KnowledgeManager(workdir)).load()
+
+            faq_file.write_text(
+                self.FAQ.replace("100 евро", "120 евро"), encoding="utf-8"
+            )
+            faq = FAQIndex(KnowledgeManager(workdir))
+            self.assertTrue(faq.load())
+            self.assertEqual(faq.match("Сколько стоит обучение?"), "120 евро в месяц.")
+
+            faq = FAQIndex(KnowledgeManager(workdir))
+            self.assertFalse(faq.load())  # Up to date, served from the index
+            self.assertEqual(faq.match("Сколько стоит обучение?"), "120 евро в месяц.")
+
+
+class ClaimJobTests(TestCase):
+    def test_claims_oldest_pending_job(self):
+        first = enqueue_job("telegram", "1", "first")
+        enqueue_job("telegram", "2", "second")
+
+        job = claim_job("worker-1")
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual(job.status, "leased")
+        self.assertEqual(job.worker, "worker-1")
+        self.assertEqual(job.attempts, 1)
+
+    def test_skips_chats_with_a_live_lease(self):
+        enqueue_job("telegram", "1", "first")
+        claim_job("worker-1")
+        # Folding only targets pending jobs, so this is a second job of chat 1
+        enqueue_job("telegram", "1", "follow-up")
+        other = enqueue_job("telegram", "2", "other chat")
+
+        self.assertEqual(claim_job("worker-2").pk, other.pk)
+        self.assertIsNone(claim_job("worker-3"))
+
+    def test_reclaims_expired_lease(self):
+        job = enqueue_job("telegram", "1", "question")
+        claim_job("worker-1")
+        Job.objects.filter(pk=job.pk).update(
+            lease_expires_at=timezone.now() - timedelta(seconds=1)
+        )
+
+        job = claim_job("worker-2")
+        self.assertEqual(job.worker, "worker-2")
+        self.assertEqual(job.attempts, 2)
+
+    def test_fails_job_after_max_attempts(self):
+        job = enqueue_job("telegram", "1", "question")
+        Job.objects.filter(pk=job.pk).update(
+            status="leased",
+            attempts=3,
+            lease_expires_at=timezone.now() - timedelta(seconds=1),
+        )
+
+        self.assertIsNone(claim_job("worker-1", max_attempts=3))
+        self.assertEqual(Job.objects.get(pk=job.pk).status, "failed")
+
+
+class KnowledgeOwnershipTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        real_client = openai_service.client
+        openai_service.client = FakeOpenAI()
+        self.addCleanup(setattr, openai_service, "client", real_client)
+
+    def test_workers_never_upload_knowledge(self):
+        manager = KnowledgeManager(self.workdir.name)
+        worker = openai_service.AIAssistant(
+            api_key="fake", knowledge_manager=manager, owns_knowledge=False
+        )
+        uploads = []
+        worker.refresh_knowledge = lambda assistant_id=None: uploads.append(1)
+        manager._search_index = ([], [], {})
+
+        worker.get_response("telegram", 1, "question")
+        worker.watcher._fire("knowledge")
+
+        self.assertEqual(uploads, [])
+        self.assertIsNone(manager._search_index)  # Caches are still dropped
+
+
+class FairLimiterTests(SimpleTestCase):
+    def test_slots_go_to_tenants_round_robin(self):
+        limiter = FairLimiter(1)
+        order = []
+
+        def turn(tenant, name):
+            with limiter.slot(tenant):
+                order.append(name)
+
+        def queued(count):
+            with limiter._cond:
+                return sum(len(q) for q in limiter._waiting.values()) == count
+
+        threads = []
+        with limiter.slot("busy"):
+            for count, (tenant, name) in enumerate(
+                [("a", "a1"), ("a", "a2"), ("b", "b1")], start=1
+            ):
+                thread = threading.Thread(target=turn, args=(tenant, name))
+                thread.start()
+                threads.append(thread)
+                while not queued(count):
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join(timeout=5)
+
+        self.assertEqual(order, ["a1", "b1", "a2"])
+
+
+class SharedKnowledgeFolderTests(SimpleTestCase):
+    def test_every_tenant_compiles_a_shared_folder(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            knowledge = Path(workdir) / "knowledge_base"
+            knowledge.mkdir()
+            (knowledge / "a.txt").write_text("Shared course notes", encoding="utf-8")
+            first, second = (
+                KnowledgeManager(workdir, knowledge_file=f"ai_assistant/kb_{name}.txt")
+                for name in ("first", "second")
+            )
+
+            self.assertTrue(first.check_and_update_knowledge())
+            self.assertTrue(second.check_and_update_knowledge())
+            self.assertTrue(second.shard_paths())
+            self.assertFalse(first.check_and_update_knowledge())
+
+
+class ProfileCommandTests(TestCase):
+    @skipIf(not hasattr(signal, "SIGUSR1"), "no SIGUSR1 on this platform")
+    def test_pid_without_a_handler_is_refused(self):
+        previous = signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        self.addCleanup(signal.signal, signal.SIGUSR1, previous)
+        if handles_signal(os.getpid(), signal.SIGUSR1) is None:
+            self.skipTest("/proc is not available")
+
+        with self.assertRaises(CommandError):
+            call_command("profile", pid=os.getpid())
+
+        signal.signal(signal.SIGUSR1, lambda signum, frame: None)
+        self.assertTrue(handles_signal(os.getpid(), signal.SIGUSR1))
+
+    def test_synthetic_report_keeps_its_lines(self):
+        out = io.StringIO()
+        with tempfile.TemporaryDirectory() as output:
+            call_command("profile", synthetic="question", output=output, stdout=out)
+        self.assertRegex(out.getvalue(), r"ncalls .*percall +filename:lineno")
+
+
+class ShardWriterTests(SimpleTestCase):
+    def test_oversized_text_is_split_across_shards(self):
+        header = "=== doc.txt ===\n"
+        text = "First line.\nA sentence. Another one ünïcödé " + "z" * 300 + "\n\n"
+        with tempfile.TemporaryDirectory() as workdir:
+            writer = ShardWriter(workdir, "kb", 64)
+            writer.write("Intro\n\n", "=== intro.txt ===\n")
+            writer.write(text, header)
+            paths = writer.close()
+
+            shards = [path.read_bytes() for path in paths]
+        self.assertGreater(len(shards), 2)
+        self.assertTrue(all(len(shard) <= 64 for shard in shards))
+        self.assertTrue(all(shard.startswith(b"=== ") for shard in shards))
+
+        body = b"".join(shards).decode("utf-8")
+        expected = "=== intro.txt ===\nIntro\n\n" + text
+        self.assertEqual(body.replace(header, ""), expected)
+
+
+class RefreshKnowledgeTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        knowledge = Path(self.workdir.name) / "knowledge_base"
+        knowledge.mkdir()
+        (knowledge / "a.txt").write_text("Course notes " * 50, encoding="utf-8")
+
+        self.fake = FakeOpenAI()
+        real_client = openai_service.client
+        openai_service.client = self.fake
+        self.addCleanup(setattr, openai_service, "client", real_client)
+        self.manager = KnowledgeManager(self.workdir.name)
+        self.manager.shard_bytes = 200
+        self.assistant = openai_service.AIAssistant(
+            api_key="fake", knowledge_manager=self.manager
+        )
+
+    def test_replaces_every_file_and_uploads_the_compiled_shards(self):
+        stores = self.fake.beta.vector_stores
+        attached = [SimpleNamespace(id=f"file_{i}") for i in range(25)]
+        detached, deleted, uploaded = [], [], []
+        stores.files.list = lambda **kw: iter(attached)
+        stores.files.delete = lambda vector_store_id, file_id: detached.append(file_id)
+        self.fake.files.delete = deleted.append
+
+        def upload(vector_store_id, files, **kw):
+            uploaded.extend(Path(stream.name) for stream in files)
+
+        stores.file_batches.upload_and_poll = upload
+
+        self.assertTrue(self.assistant.refresh_knowledge())
+        expected = [file.id for file in attached]
+        self.assertEqual(detached, expected)
+        self.assertEqual(deleted, expected)
+        self.assertGreater(len(uploaded), 1)
+        self.assertEqual(uploaded, self.manager.shard_paths())
+        self.assertFalse(self.assistant.refresh_knowledge())
+
+    def test_failed_upload_is_retried_on_the_next_sync(self):
+        def upload(vector_store_id, files, **kw):
+            raise RuntimeError("upload failed")
+
+        self.fake.beta.vector_stores.file_batches.upload_and_poll = upload
+        with self.assertRaises(RuntimeError):
+            self.assistant.refresh_knowledge()
+        self.assertIsNotNone(self.manager.knowledge_changed())
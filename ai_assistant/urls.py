@@ -1,17 +1,7 @@
 from django.urls import path
-from .views import ChatMappingListView, ChatMappingDetailView
+from .views import queue_metrics, usage_metrics
 
 urlpatterns = [
-    path("chats/", ChatMappingListView.as_view(), name="chat-list"),
-    path(
-        "chats/<str:integration>/<str:chat_id>/",
-        ChatMappingDetailView.as_view(),
-        name="chat-detail",
-    ),
-    path("chats/", ChatMappingListView.as_view(), name="chat-list"),
-    path(
-        "chats/<str:integration>/<str:chat_id>/",
-        ChatMappingDetailView.as_view(),
-        name="chat-detail",
-    ),
+    path("metrics/usage/", usage_metrics, name="usage-metrics"),
+    path("metrics/queue/", queue_metrics, name="queue-metrics"),
 ]
@@ -1,5 +1,9 @@
-from .models import ChatMapping
-from datetime import datetime
+from .models import ChatMapping, ChatUsage, Job
+from datetime import datetime, timedelta
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, F, Q, Sum
+from django.http import JsonResponse
+from django.utils import timezone
 
 
 def get_chat_mapping(integration, chat_id=None, assistant_id=None):
@@ -27,3 +31,214 @@ def update_chat_mapping(integration, chat_id, assistant_id, thread_id):
 
 def delete_chat_mapping(integration, chat_id):
     ChatMapping.objects.filter(integration=integration, chat_id=chat_id).delete()
+
+
+def record_usage(
+    integration,
+    chat_id,
+    prompt_tokens=0,
+    completion_tokens=0,
+    run_seconds=0.0,
+    file_search_calls=0,
+    turns=1,
+):
+    filters = {
+        "integration": integration,
+        "chat_id": chat_id,
+        "day": timezone.localdate(),
+    }
+    ChatUsage.objects.get_or_create(**filters)
+    ChatUsage.objects.filter(**filters).update(
+        turns=F("turns") + turns,
+        prompt_tokens=F("prompt_tokens") + prompt_tokens,
+        completion_tokens=F("completion_tokens") + completion_tokens,
+        run_seconds=F("run_seconds") + run_seconds,
+        file_search_calls=F("file_search_calls") + file_search_calls,
+    )
+
+
+def get_tokens_used(integration=None, chat_id=None, day=None):
+    filters = {"day": day or timezone.localdate()}
+    if integration:
+        filters["integration"] = integration
+    if chat_id:
+        filters["chat_id"] = chat_id
+
+    totals = ChatUsage.objects.filter(**filters).aggregate(
+        prompt=Sum("prompt_tokens"), completion=Sum("completion_tokens")
+    )
+    return (totals["prompt"] or 0) + (totals["completion"] or 0)
+
+
+def get_usage_summary(days=1, integration=None, chat_id=None, limit=None):
+    """Usage per chat over the last `days` days, heaviest chats first."""
+    filters = {"day__gt": timezone.localdate() - timedelta(days=days)}
+    if integration:
+        filters["integration"] = integration
+    if chat_id:
+        filters["chat_id"] = chat_id
+
+    rows = (
+        ChatUsage.objects.filter(**filters)
+        .values("integration", "chat_id")
+        .annotate(
+            # Computed first: the aggregates below shadow the field names
+            total_tokens=Sum(F("prompt_tokens") + F("completion_tokens")),
+            turns=Sum("turns"),
+            prompt_tokens=Sum("prompt_tokens"),
+            completion_tokens=Sum("completion_tokens"),
+            run_seconds=Sum("run_seconds"),
+            file_search_calls=Sum("file_search_calls"),
+        )
+        .order_by("-total_tokens")
+    )
+    return list(rows[:limit] if limit else rows)
+
+
+def positive_int_param(request, name, default):
+    """Read a positive integer query parameter; None if it is invalid."""
+    try:
+        value = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+@staff_member_required  # Exposes chat ids and spend
+def usage_metrics(request):
+    days = positive_int_param(request, "days", 1)
+    if days is None:
+        return JsonResponse({"error": "days must be a positive integer"}, status=400)
+    chats = get_usage_summary(days=days)
+    return JsonResponse(
+        {
+            "days": days,
+            "turns": sum(row["turns"] for row in chats),
+            "prompt_tokens": sum(row["prompt_tokens"] for row in chats),
+            "completion_tokens": sum(row["completion_tokens"] for row in chats),
+            "run_seconds": sum(row["run_seconds"] for row in chats),
+            "file_search_calls": sum(row["file_search_calls"] for row in chats),
+            "top_chats": chats[:10],
+        }
+    )
+
+
+def enqueue_job(integration, chat_id, prompt):
+    """Queue a turn, folding it into the chat's job if that is still unclaimed."""
+    pending = (
+        Job.objects.filter(integration=integration, chat_id=chat_id, status="pending")
+        .order_by("-created_at")
+        .first()
+    )
+    if pending:
+        updated = Job.objects.filter(pk=pending.pk, status="pending").update(
+            prompt=pending.prompt + "\n" + prompt
+        )
+        if updated:
+            return pending
+
+    return Job.objects.create(integration=integration, chat_id=chat_id, prompt=prompt)
+
+
+def claim_job(worker, lease_seconds=120, max_attempts=3):
+    """
+    Lease the oldest claimable job: pending ones, or leased ones whose worker
+    died and let the lease expire. Chats with a live lease are skipped so one
+    thread never has two runs at once. The conditional update makes the claim
+    atomic across processes.
+    """
+    now = timezone.now()
+    Job.objects.filter(
+        status="leased", lease_expires_at__lt=now, attempts__gte=max_attempts
+    ).update(status="failed", error="Lease expired too many times", finished_at=now)
+
+    busy = set(
+        Job.objects.filter(status="leased", lease_expires_at__gte=now).values_list(
+            "integration", "chat_id"
+        )
+    )
+    claimable = Job.objects.filter(
+        Q(status="pending") | Q(status="leased", lease_expires_at__lt=now)
+    ).order_by("created_at")
+
+    for job in claimable[:50]:
+        if (job.integration, job.chat_id) in busy:
+            continue
+        updated = Job.objects.filter(
+            pk=job.pk, status=job.status, attempts=job.attempts
+        ).update(
+            status="leased",
+            worker=worker,
+            attempts=F("attempts") + 1,
+            lease_expires_at=now + timedelta(seconds=lease_seconds),
+        )
+        if updated:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def extend_lease(job, lease_seconds=120):
+    """Push the lease of a job this worker still holds; False if it lost it."""
+    return bool(
+        Job.objects.filter(pk=job.pk, worker=job.worker, status="leased").update(
+            lease_expires_at=timezone.now() + timedelta(seconds=lease_seconds)
+        )
+    )
+
+
+def complete_job(job):
+    Job.objects.filter(pk=job.pk, worker=job.worker).update(
+        status="done", error=None, finished_at=timezone.now()
+    )
+
+
+def fail_job(job, error, max_attempts=3):
+    """Put the job back for another attempt, or give up after max_attempts."""
+    retry = job.attempts < max_attempts
+    Job.objects.filter(pk=job.pk, worker=job.worker).update(
+        status="pending" if retry else "failed",
+        error=str(error),
+        lease_expires_at=None,
+        finished_at=None if retry else timezone.now(),
+    )
+
+
+def get_queue_stats(window_minutes=60):
+    now = timezone.now()
+    counts = dict(
+        Job.objects.values_list("status").annotate(total=Count("id")).order_by()
+    )
+    oldest = (
+        Job.objects.filter(status="pending")
+        .order_by("created_at")
+        .values_list("created_at", flat=True)
+        .first()
+    )
+    throughput = (
+        Job.objects.filter(
+            status="done", finished_at__gte=now - timedelta(minutes=window_minutes)
+        )
+        .values_list("worker")
+        .annotate(total=Count("id"))
+        .order_by()
+    )
+    return {
+        "pending": counts.get("pending", 0),
+        "leased": counts.get("leased", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_pending_seconds": (now - oldest).total_seconds() if oldest else 0,
+        "window_minutes": window_minutes,
+        "done_per_worker": dict(throughput),
+    }
+
+
+@staff_member_required
+def queue_metrics(request):
+    window = positive_int_param(request, "window", 60)
+    if window is None:
+        return JsonResponse(
+            {"error": "window must be a positive integer"}, status=400
+        )
+    return JsonResponse(get_queue_stats(window_minutes=window))
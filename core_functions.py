@@ -1,7 +1,13 @@
 import importlib.util
 import hashlib
 import json
-from typing import Dict
+import math
+import re
+import os
+import threading
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 from pathlib import Path
 from functools import lru_cache
 from tools.video_to_text import process_new_videos
@@ -10,6 +16,14 @@ import logging
 import hashlib
 
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # Fall back to polling when watchdog is not installed
+    Observer = None
+    FileSystemEventHandler = object
+
+
 load_dotenv()
 logger = logging.getLogger(__name__)
 
@@ -80,19 +94,191 @@ class IntegrationLoader:
             return False
 
 
+class DocumentStore:
+    """
+    Content-addressed store of knowledge chunks. Documents are split into
+    paragraphs (or JSON items) and every chunk is kept once, keyed by the hash
+    of its normalised text, so reposted videos and boilerplate are only
+    embedded once across the whole corpus. With keep_text=False only the
+    hashes and the byte counts are kept, for callers that stream the chunks
+    elsewhere.
+    """
+
+    def __init__(self, keep_text: bool = True):
+        self.keep_text = keep_text
+        self.hashes: set = set()
+        self.chunks: Dict[str, str] = {}  # hash -> chunk text, if keep_text
+        self.documents: Dict[str, List[str]] = {}  # name -> hashes first seen there
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        self.duplicates = 0
+
+    @staticmethod
+    def chunk_hash(text: str) -> str:
+        normalized = " ".join(text.split()).casefold()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def estimate_tokens(size: int) -> int:
+        """Rough token count for a number of UTF-8 bytes (~4 bytes per token)."""
+        return size // 4
+
+    @staticmethod
+    def split_text(text: str) -> List[str]:
+        """Split text into paragraphs on blank lines."""
+        return [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+
+    @staticmethod
+    def split_json(data) -> List[str]:
+        """Split JSON into compact items: list elements or top-level keys."""
+        if isinstance(data, list):
+            items = data
+        elif isinstance(data, dict):
+            items = [{key: value} for key, value in data.items()]
+        else:
+            items = [data]
+        return [
+            json.dumps(item, ensure_ascii=False, separators=(",", ":"))
+            for item in items
+        ]
+
+    def add_chunk(self, name: str, chunk: str) -> bool:
+        """Add one chunk of a document; returns False if it is a duplicate."""
+        size = len(chunk.encode("utf-8"))
+        self.bytes_in += size
+        digest = self.chunk_hash(chunk)
+        if digest in self.hashes:
+            self.duplicates += 1
+            return False
+
+        self.hashes.add(digest)
+        if self.keep_text:
+            self.chunks[digest] = chunk
+        self.bytes_stored += size
+        self.documents.setdefault(name, []).append(digest)
+        return True
+
+    def add_document(self, name: str, chunks: Iterable[str]) -> int:
+        """Add a document's chunks; returns how many were new to the store."""
+        return sum(self.add_chunk(name, chunk) for chunk in chunks)
+
+    def stats(self) -> Dict[str, int]:
+        bytes_saved = self.bytes_in - self.bytes_stored
+        return {
+            "documents": len(self.documents),
+            "chunks": len(self.hashes),
+            "duplicates": self.duplicates,
+            "bytes_in": self.bytes_in,
+            "bytes_stored": self.bytes_stored,
+            "bytes_saved": bytes_saved,
+            "tokens_saved": self.estimate_tokens(bytes_saved),
+        }
+
+
+class ShardWriter:
+    """
+    Write text into numbered files of at most max_bytes each. The current
+    document header is repeated at the top of a new shard so every shard
+    stays self-describing; text too large for one shard is split at line,
+    sentence or word breaks, or at a character boundary as a last resort.
+    """
+
+    def __init__(self, output_dir: Path, prefix: str, max_bytes: int):
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.paths: List[Path] = []
+        self._file = None
+        self._size = 0
+        self._header: Optional[str] = None
+
+    @staticmethod
+    def split(text: str, limit: int) -> Iterator[str]:
+        """Yield pieces of text that are at most limit UTF-8 bytes each."""
+        while len(text.encode("utf-8")) > limit:
+            head = text.encode("utf-8")[:limit].decode("utf-8", errors="ignore")
+            cut = 0
+            for separator in ("\n", ". ", " "):
+                cut = head.rfind(separator) + len(separator)
+                if cut >= len(separator):
+                    break
+                cut = 0
+            cut = cut or max(len(head), 1)
+            yield text[:cut]
+            text = text[cut:]
+        if text:
+            yield text
+
+    def write(self, text: str, header: str):
+        room = max(self.max_bytes - len(header.encode("utf-8")), 1)
+        if len(text.encode("utf-8")) > room:
+            for piece in self.split(text, room):
+                self._write(piece, header)
+        else:
+            self._write(text, header)
+
+    def _write(self, text: str, header: str):
+        data = text.encode("utf-8")
+        new_document = header != self._header
+        if new_document:
+            data = header.encode("utf-8") + data
+        full = self._size and self._size + len(data) > self.max_bytes
+        if self._file is None or full:
+            self._roll()
+            if not new_document:
+                data = header.encode("utf-8") + data
+        self._header = header
+        self._file.write(data)
+        self._size += len(data)
+
+    def _roll(self):
+        if self._file:
+            self._file.close()
+        path = self.output_dir / f"{self.prefix}-{len(self.paths) + 1:03d}.txt"
+        self._file = path.open("wb")
+        self._size = 0
+        self.paths.append(path)
+
+    def close(self) -> List[Path]:
+        if self._file:
+            self._file.close()
+            self._file = None
+        return self.paths
+
+
 class KnowledgeManager:
-    def __init__(self, base_dir: str = "."):
+    def __init__(
+        self,
+        base_dir: str = ".",
+        knowledge_dir: str = "knowledge_base",
+        instructions_file: str = "instructions.txt",
+        knowledge_file: str = "ai_assistant/knowledge_base.txt",
+        faq_index_file: str = "faq_index.json",
+    ):
         self.base_dir = Path(base_dir)
-        self.knowledge_path = self.base_dir / "knowledge_base"
-        self.hash_file = self.knowledge_path / ".hash"
-        self.instructions_file = self.base_dir / "instructions.txt"
+        self.knowledge_path = self.base_dir / knowledge_dir
+        self.instructions_file = self.base_dir / instructions_file
+        # Only names the upload shards now; the file itself is not written
+        self.knowledge_file = self.base_dir / knowledge_file
+        self.faq_index_file = self.base_dir / faq_index_file
+        # Compiled upload shards, e.g. ai_assistant/knowledge_base_shards/
+        self.shards_dir = self.knowledge_file.with_name(
+            f"{self.knowledge_file.stem}_shards"
+        )
+        # Hash of the folder the shards were compiled from; kept next to the
+        # shards because tenants may share one knowledge folder
+        self.hash_file = self.shards_dir / ".hash"
+        self.shard_bytes = int(os.getenv("KNOWLEDGE_SHARD_BYTES", "1000000"))
         self.videos_path = self.base_dir / "videos"
         self.videos_hash_file = self.videos_path / ".hash"
+        self.knowledge_stats: Dict[str, int] = {}  # Of the last compilation
+        self._search_index = None  # Built lazily by search()
+        self._search_lock = threading.Lock()
 
         logging.basicConfig(level=logging.DEBUG)
         self.logger = logging.getLogger(__name__)
 
-    @lru_cache(maxsize=1)
+    @lru_cache(maxsize=None)  # One entry per tenant's manager
     def load_instructions(self) -> str:
         """Loads and caches instructions."""
 
@@ -106,6 +292,13 @@ class KnowledgeManager:
             print("Instructions file not found")
             return "Respond concisely and to the point."
 
+    def get_watcher(self) -> "KnowledgeWatcher":
+        """Shared watcher for this manager's instructions and knowledge folder."""
+        # Paths already include base_dir, so resolve them from the cwd
+        return get_knowledge_watcher(
+            ".", str(self.instructions_file), str(self.knowledge_path)
+        )
+
     def get_file_hash(self, file_path: Path) -> str:
         """Calculate file hash using SHA256."""
         hasher = hashlib.sha256()
@@ -135,60 +328,132 @@ class KnowledgeManager:
                 rel_path = file_path.relative_to(folder_path).as_posix().encode("utf-8")
                 hasher.update(rel_path)
 
-                content = file_path.read_bytes()  # Читаем файл в бинарном режиме
-                hasher.update(content)
+                with file_path.open("rb") as f:  # Читаем файл в бинарном режиме
+                    while chunk := f.read(65536):
+                        hasher.update(chunk)
             except Exception as e:
                 print(f"Ошибка чтения {file_path}: {e}")
 
         return hasher.hexdigest()
 
-    def load_knowledge_base(self) -> str:
-        """Load knowledge base with efficient file handling."""
+    def iter_documents(self) -> Iterator[Tuple[str, Iterator[str]]]:
+        """Yield (file name, chunk iterator) for every knowledge file."""
         if not self.knowledge_path.exists():
-            self.logger.warning("Knowledge base directory does not exist.")
-            print("Knowledge base directory does not exist.")
-            return "No data in the knowledge base."
+            return
 
-        knowledge_parts = []
         for file_path in sorted(self.knowledge_path.glob("*")):
             if file_path.suffix == ".txt":
-                knowledge_parts.append(
-                    f"\n=== {file_path.name} ===\n{file_path.read_text(encoding='utf-8')}"
-                )
+                yield file_path.name, self.iter_paragraphs(file_path)
             elif file_path.suffix == ".json":
                 try:
                     data = json.loads(file_path.read_text(encoding="utf-8"))
-                    knowledge_parts.append(
-                        f"\n=== {file_path.name} ===\n{json.dumps(data, indent=4)}"
-                    )
                 except json.JSONDecodeError:
                     self.logger.warning(f"Failed to parse JSON file: {file_path.name}")
                     continue
+                yield file_path.name, iter(DocumentStore.split_json(data))
 
-        # Log the knowledge content before saving
-        if knowledge_parts:
-            knowledge_text = "\n".join(knowledge_parts)
-            self.logger.debug(f"Knowledge base content:\n{knowledge_text[:500]}...")
-            knowledge_file_path = self.base_dir / "ai_assistant/knowledge_base.txt"
-            try:
-                with open(knowledge_file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                    if len(content) < 10:
-                        logger.error("Knowledge base file is empty or too small")
-                        return None
-                    logger.info(
-                        f"Knowledge base loaded successfully with {len(content)} characters"
-                    )
-                    return str(knowledge_file_path)
-            except Exception as e:
-                logger.error(f"Failed to verify knowledge base file: {e}")
-                return None
+    @staticmethod
+    def iter_paragraphs(file_path: Path) -> Iterator[str]:
+        """Stream a text file paragraph by paragraph (split on blank lines)."""
+        paragraph: List[str] = []
+        with file_path.open(encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    paragraph.append(line)
+                elif paragraph:
+                    yield "".join(paragraph).strip()
+                    paragraph = []
+        if paragraph:
+            yield "".join(paragraph).strip()
 
-        self.logger.warning("No data found in the knowledge base.")
-        return "No data in the knowledge base."
+    def build_document_store(self) -> DocumentStore:
+        """Split every knowledge file into deduplicated chunks."""
+        store = DocumentStore()
+        for name, chunks in self.iter_documents():
+            store.add_document(name, chunks)
+        return store
 
-    def check_and_update_knowledge(self) -> bool:
-        """Check for knowledge base updates efficiently."""
+    def search(self, query: str, limit: int = 3) -> List[str]:
+        """Local keyword search over the knowledge chunks, best matches first."""
+        with self._search_lock:
+            if self._search_index is None:
+                store = self.build_document_store()
+                chunks = list(store.chunks.values())
+                terms = [set(self.tokenize(chunk)) for chunk in chunks]
+                doc_freq = defaultdict(int)
+                for chunk_terms in terms:
+                    for term in chunk_terms:
+                        doc_freq[term] += 1
+                idf = {
+                    term: math.log(1 + len(chunks) / freq)
+                    for term, freq in doc_freq.items()
+                }
+                self._search_index = (chunks, terms, idf)
+            chunks, terms, idf = self._search_index
+
+        query_terms = set(self.tokenize(query))
+        scored = []
+        for chunk, chunk_terms in zip(chunks, terms):
+            score = sum(idf[term] for term in query_terms & chunk_terms)
+            if score:
+                scored.append((score, chunk))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [chunk for _, chunk in scored[:limit]]
+
+    def clear_caches(self):
+        """Forget what was derived from the knowledge files, e.g. after an edit."""
+        with self._search_lock:
+            self._search_index = None
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return [word for word in re.findall(r"\w+", text.casefold()) if len(word) > 2]
+
+    def shard_paths(self) -> List[Path]:
+        """The compiled knowledge shards, in upload order."""
+        return sorted(self.shards_dir.glob("*.txt"))
+
+    def load_knowledge_base(self) -> List[Path]:
+        """
+        Compile the knowledge files into deduplicated shards of at most
+        shard_bytes each. Files are streamed chunk by chunk and only chunk
+        hashes are kept, so memory stays flat as the corpus grows.
+        """
+        if not self.knowledge_path.exists():
+            self.logger.warning("Knowledge base directory does not exist.")
+            print("Knowledge base directory does not exist.")
+            return []
+
+        self.shards_dir.mkdir(parents=True, exist_ok=True)
+        for old_shard in self.shard_paths():
+            old_shard.unlink()
+
+        store = DocumentStore(keep_text=False)
+        writer = ShardWriter(
+            self.shards_dir, self.knowledge_file.stem, self.shard_bytes
+        )
+        try:
+            for name, chunks in self.iter_documents():
+                header = f"\n=== {name} ===\n"
+                for chunk in chunks:
+                    if store.add_chunk(name, chunk):
+                        writer.write(chunk + "\n\n", header)
+        finally:
+            shards = writer.close()
+
+        self.knowledge_stats = store.stats()
+        if not shards:
+            self.logger.warning("No data found in the knowledge base.")
+            return []
+
+        self.logger.info(
+            f"Knowledge base compiled into {len(shards)} shards: "
+            + " ".join(f"{key}={value}" for key, value in self.knowledge_stats.items())
+        )
+        return shards
+
+    def knowledge_changed(self) -> Optional[str]:
+        """The folder hash if it differs from the last synced one, else None."""
         new_hash = self.get_folder_hash(self.knowledge_path)
         try:
             old_hash = self.hash_file.read_text().strip()
@@ -197,12 +462,193 @@ class KnowledgeManager:
             old_hash = ""
 
         print(f"[DEBUG] New hash: {new_hash}")
+        return new_hash if new_hash != old_hash else None
 
-        if new_hash != old_hash:
-            self.load_knowledge_base()
-            self.hash_file.write_text(new_hash)
-            return True
-        return False
+    def mark_knowledge_synced(self, folder_hash: str):
+        self.shards_dir.mkdir(parents=True, exist_ok=True)
+        self.hash_file.write_text(folder_hash)
+
+    def check_and_update_knowledge(self) -> bool:
+        """Check for knowledge base updates efficiently."""
+        new_hash = self.knowledge_changed()
+        if new_hash is None:
+            return False
+        self.clear_caches()
+        self.load_knowledge_base()
+        self.mark_knowledge_synced(new_hash)
+        return True
+
+
+class FAQIndex:
+    """
+    Precomputed question variants -> vetted answers. Entries come from
+    "Q:"/"A:" blocks in instructions.txt and the knowledge files (consecutive
+    Q lines are variants of one question) and from JSON lists of
+    {"questions": [...], "answer": ...}. Prompts are matched by character
+    trigram similarity through an inverted index, so canonical questions are
+    answered without starting an assistant run.
+    """
+
+    QUESTION = re.compile(r"^\s*(?:Q|Question|Вопрос)\s*[:\-]\s*(.+)$", re.I)
+    ANSWER = re.compile(r"^\s*(?:A|Answer|Ответ)\s*[:\-]\s*(.*)$", re.I)
+
+    def __init__(self, knowledge_manager: KnowledgeManager, threshold: float = 0.8):
+        self.knowledge_manager = knowledge_manager
+        self.index_path = knowledge_manager.faq_index_file
+        self.threshold = threshold
+        self.files: Dict[str, Dict] = {}  # source path -> {"hash", "entries"}
+        self._variants: List[tuple] = []  # (trigrams, answer)
+        self._inverted: Dict[str, List[int]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def trigrams(text: str) -> set:
+        text = " " + " ".join(re.findall(r"\w+", text.casefold())) + " "
+        return {text[i : i + 3] for i in range(len(text) - 2)}
+
+    @classmethod
+    def parse_text(cls, text: str) -> List[Dict]:
+        entries = []
+        questions: List[str] = []
+        answer: Optional[List[str]] = None
+
+        def finish():
+            if questions and answer and "\n".join(answer).strip():
+                entries.append(
+                    {"questions": list(questions), "answer": "\n".join(answer).strip()}
+                )
+
+        for line in text.splitlines():
+            question = cls.QUESTION.match(line)
+            if question:
+                if answer is not None:
+                    finish()
+                    questions, answer = [], None
+                questions.append(question.group(1).strip())
+                continue
+            if questions and answer is None:
+                start = cls.ANSWER.match(line)
+                if start:
+                    answer = [start.group(1)]
+            elif answer is not None:
+                if line.startswith("=== "):
+                    finish()
+                    questions, answer = [], None
+                else:
+                    answer.append(line)
+        finish()
+        return entries
+
+    @staticmethod
+    def parse_json(data) -> List[Dict]:
+        entries = []
+        for item in data if isinstance(data, list) else []:
+            if not isinstance(item, dict) or not item.get("answer"):
+                continue
+            questions = item.get("questions") or [item.get("question")]
+            questions = [q for q in questions if q]
+            if questions:
+                entries.append({"questions": questions, "answer": item["answer"]})
+        return entries
+
+    def sources(self) -> List[Path]:
+        manager = self.knowledge_manager
+        paths = [manager.instructions_file]
+        if manager.knowledge_path.exists():
+            paths += sorted(
+                p
+                for p in manager.knowledge_path.glob("*")
+                if p.suffix in (".txt", ".json") and not p.name.startswith(".")
+            )
+        return [p for p in paths if p.is_file()]
+
+    def load(self) -> bool:
+        """
+        Load the precomputed index and re-parse the sources that changed since
+        it was written, e.g. while the bot was down. True if any did.
+        """
+        try:
+            self.files = json.loads(self.index_path.read_text(encoding="utf-8"))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.files = {}
+        changed = self.rebuild()
+        if not changed:
+            self._reindex()
+        return changed
+
+    def rebuild(self) -> bool:
+        """Re-parse only the sources whose content changed; returns True if any did."""
+        files = {}
+        changed = False
+        for path in self.sources():
+            key = path.as_posix()
+            digest = self.knowledge_manager.get_file_hash(path)
+            cached = self.files.get(key)
+            if cached and cached["hash"] == digest:
+                files[key] = cached
+                continue
+
+            changed = True
+            try:
+                if path.suffix == ".json":
+                    data = json.loads(path.read_text(encoding="utf-8"))
+                    entries = self.parse_json(data)
+                else:
+                    entries = self.parse_text(path.read_text(encoding="utf-8"))
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Skipping {path.name} in FAQ index: {e}")
+                entries = []
+            files[key] = {"hash": digest, "entries": entries}
+
+        changed = changed or files.keys() != self.files.keys()
+        if changed or not self.index_path.exists():
+            self.files = files
+            # Every process rebuilds the index; replace it atomically so none
+            # of them reads a half-written file
+            partial = self.index_path.with_name(
+                f".{self.index_path.name}.{os.getpid()}"
+            )
+            partial.write_text(
+                json.dumps(files, ensure_ascii=False, separators=(",", ":")),
+                encoding="utf-8",
+            )
+            os.replace(partial, self.index_path)
+            self._reindex()
+            logger.info(f"FAQ index rebuilt with {len(self._variants)} variants")
+        return changed
+
+    def _reindex(self):
+        variants = []
+        inverted = defaultdict(list)
+        for source in self.files.values():
+            for entry in source["entries"]:
+                for question in entry["questions"]:
+                    grams = self.trigrams(question)
+                    for gram in grams:
+                        inverted[gram].append(len(variants))
+                    variants.append((grams, entry["answer"]))
+        with self._lock:
+            self._variants = variants
+            self._inverted = dict(inverted)
+
+    def match(self, prompt: str) -> Optional[str]:
+        """Return the vetted answer of the closest variant above the threshold."""
+        grams = self.trigrams(prompt)
+        with self._lock:
+            variants, inverted = self._variants, self._inverted
+
+        shared = defaultdict(int)
+        for gram in grams:
+            for index in inverted.get(gram, ()):
+                shared[index] += 1
+
+        best_score, best_answer = 0.0, None
+        for index, common in shared.items():
+            variant_grams, answer = variants[index]
+            score = common / (len(grams) + len(variant_grams) - common)
+            if score > best_score:
+                best_score, best_answer = score, answer
+        return best_answer if best_score >= self.threshold else None
 
 
 class VideoManager:
@@ -243,15 +689,335 @@ class VideoManager:
             print(f"Error importing video processing module: {e}")
 
 
+# watchdog events that mean a file changed; "closed" is a close after writing
+WATCHED_EVENTS = {"created", "modified", "moved", "deleted", "closed"}
+
+
+class KnowledgeWatcher:
+    """
+    Watch instructions.txt, knowledge_base/ and videos/video_ids.json and push
+    debounced change events to subscribers. Uses inotify through watchdog when
+    it is installed and falls back to polling file stats otherwise.
+    """
+
+    def __init__(
+        self,
+        base_dir: str = ".",
+        instructions_file: str = "instructions.txt",
+        knowledge_dir: str = "knowledge_base",
+        debounce: float = 1.0,
+        poll_interval: float = 2.0,
+    ):
+        base = Path(base_dir).resolve()
+        self.targets = {
+            "instructions": base / instructions_file,
+            "knowledge": base / knowledge_dir,
+            "videos": base / "videos" / "video_ids.json",
+        }
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self._listeners: Dict[str, List[Callable[[], None]]] = defaultdict(list)
+        self._timers: Dict[str, threading.Timer] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._poll_thread: Optional[threading.Thread] = None
+
+    def subscribe(self, kind: str, callback: Callable[[], None]):
+        """Register a callback for 'instructions', 'knowledge' or 'videos'."""
+        if kind not in self.targets:
+            raise ValueError(f"Unknown watch target: {kind}")
+        self._listeners[kind].append(callback)
+
+    def is_running(self) -> bool:
+        return self._observer is not None or self._poll_thread is not None
+
+    def start(self):
+        """Start watching; safe to call more than once."""
+        if self.is_running():
+            return
+        self._stop.clear()
+
+        if Observer is not None:
+            try:
+                self._start_observer()
+                logger.info("Knowledge watcher started (inotify)")
+                return
+            except Exception as e:
+                logger.warning(f"Falling back to polling watcher: {e}")
+                self._observer = None
+
+        self._poll_thread = threading.Thread(
+            target=self._poll, name="knowledge-watcher", daemon=True
+        )
+        self._poll_thread.start()
+        logger.info("Knowledge watcher started (polling)")
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+            self._poll_thread = None
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+    def notify(self, path):
+        """Schedule a debounced event for whichever target the path belongs to."""
+        kind = self._kind_for(Path(path))
+        if not kind:
+            return
+
+        with self._lock:
+            timer = self._timers.pop(kind, None)
+            if timer:
+                timer.cancel()
+            timer = threading.Timer(self.debounce, self._fire, args=(kind,))
+            timer.daemon = True
+            self._timers[kind] = timer
+            timer.start()
+
+    def _kind_for(self, path: Path) -> Optional[str]:
+        # Hidden files include the .hash bookkeeping we write ourselves
+        if path.name.startswith("."):
+            return None
+        for kind, target in self.targets.items():
+            if path == target or target in path.parents:
+                return kind
+        return None
+
+    def _fire(self, kind: str):
+        with self._lock:
+            self._timers.pop(kind, None)
+
+        logger.info(f"Change detected in {kind}")
+        for callback in list(self._listeners[kind]):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error handling {kind} change: {e}")
+
+    def _start_observer(self):
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # Ignore "opened" (and any other read-only event): subscribers
+                # read the files they watch and would retrigger themselves
+                if event.event_type not in WATCHED_EVENTS:
+                    return
+                if event.is_directory and event.event_type == "modified":
+                    return
+                watcher.notify(event.src_path)
+                dest_path = getattr(event, "dest_path", None)
+                if dest_path:
+                    watcher.notify(dest_path)
+
+        observer = Observer()
+        handler = Handler()
+        watched = set()
+        for kind, target in self.targets.items():
+            if kind == "knowledge":
+                folder, recursive = target, True
+            else:
+                folder, recursive = target.parent, False
+            if folder.is_dir() and folder not in watched:
+                observer.schedule(handler, str(folder), recursive=recursive)
+                watched.add(folder)
+        observer.start()
+        self._observer = observer
+
+    def _snapshot(self, target: Path):
+        """Cheap change fingerprint built from file stats only."""
+        try:
+            if target.is_dir():
+                return tuple(
+                    sorted(
+                        (p.as_posix(), p.stat().st_mtime_ns, p.stat().st_size)
+                        for p in target.rglob("*")
+                        if p.is_file() and not p.name.startswith(".")
+                    )
+                )
+            stat = target.stat()
+            return (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _poll(self):
+        snapshots = {kind: self._snapshot(t) for kind, t in self.targets.items()}
+        while not self._stop.wait(self.poll_interval):
+            for kind, target in self.targets.items():
+                snapshot = self._snapshot(target)
+                if snapshot != snapshots[kind]:
+                    snapshots[kind] = snapshot
+                    self.notify(target)
+
+
+_watchers: Dict[tuple, KnowledgeWatcher] = {}
+_watchers_lock = threading.Lock()
+
+
+def get_knowledge_watcher(
+    base_dir: str = ".",
+    instructions_file: str = "instructions.txt",
+    knowledge_dir: str = "knowledge_base",
+) -> KnowledgeWatcher:
+    """Shared watcher so every component subscribes to the same instance."""
+    base = Path(base_dir).resolve()
+    key = (base / instructions_file, base / knowledge_dir)
+    with _watchers_lock:
+        if key not in _watchers:
+            _watchers[key] = KnowledgeWatcher(
+                base_dir, instructions_file, knowledge_dir
+            )
+        return _watchers[key]
+
+
+def start_knowledge_watchers():
+    """Start every watcher created so far, e.g. one per tenant."""
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+    for watcher in watchers:
+        watcher.start()
+
+
+class TenantConfig:
+    """Assistant, instructions, knowledge folder and bot token of one school."""
+
+    def __init__(
+        self,
+        name: str,
+        assistant_name: Optional[str],
+        bot_token: Optional[str],
+        instructions_file: str = "instructions.txt",
+        knowledge_dir: str = "knowledge_base",
+        vector_store_name: Optional[str] = None,
+        knowledge_file: Optional[str] = None,
+        faq_index_file: Optional[str] = None,
+    ):
+        self.name = name
+        self.bot_token = bot_token
+        self.instructions_file = instructions_file
+        self.knowledge_dir = knowledge_dir
+        # Assistants, vector stores and generated files get a per-tenant name
+        # unless configured explicitly, so one school's sync never touches
+        # another school's assistant or corpus
+        tenant = "" if name == "default" else f" ({name})"
+        self.assistant_name = assistant_name or (
+            f"Online School Assistant{tenant}" if tenant else None
+        )
+        self.vector_store_name = (
+            vector_store_name or f"Online School Statements{tenant}"
+        )
+        suffix = "" if name == "default" else f"_{name}"
+        self.knowledge_file = (
+            knowledge_file or f"ai_assistant/knowledge_base{suffix}.txt"
+        )
+        self.faq_index_file = faq_index_file or f"faq_index{suffix}.json"
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TenantConfig":
+        token = data.get("bot_token") or os.getenv(data.get("bot_token_env", ""))
+        return cls(
+            name=data["name"],
+            assistant_name=data.get("assistant_name"),
+            bot_token=token,
+            instructions_file=data.get("instructions", "instructions.txt"),
+            knowledge_dir=data.get("knowledge_dir", "knowledge_base"),
+            vector_store_name=data.get("vector_store_name"),
+            knowledge_file=data.get("knowledge_file"),
+            faq_index_file=data.get("faq_index_file"),
+        )
+
+    @classmethod
+    def default(cls) -> "TenantConfig":
+        """The single-school setup configured through environment variables."""
+        return cls(
+            name="default",
+            assistant_name=os.getenv("ASSISTANT_NAME"),
+            bot_token=os.getenv("TELEGRAM_BOT_TOKEN"),
+        )
+
+    def knowledge_manager(self) -> "KnowledgeManager":
+        return KnowledgeManager(
+            knowledge_dir=self.knowledge_dir,
+            instructions_file=self.instructions_file,
+            knowledge_file=self.knowledge_file,
+            faq_index_file=self.faq_index_file,
+        )
+
+    def integration(self, integration: str) -> str:
+        """Integration key for chat mappings, namespaced per tenant."""
+        # Bots of different tenants see the same Telegram chat ids
+        return integration if self.name == "default" else f"{integration}:{self.name}"
+
+
+def load_tenant_configs(path: Optional[str] = None) -> List[TenantConfig]:
+    """Read tenants from TENANTS_FILE (a JSON list) or fall back to the env setup."""
+    tenants_file = Path(path or os.getenv("TENANTS_FILE", "tenants.json"))
+    if not tenants_file.exists():
+        return [TenantConfig.default()]
+
+    data = json.loads(tenants_file.read_text(encoding="utf-8"))
+    return [TenantConfig.from_dict(item) for item in data]
+
+
+class FairLimiter:
+    """
+    Caps how many turns run at once across all tenants. When a slot frees up
+    it goes to the tenants round-robin, so a busy school cannot starve the
+    others.
+    """
+
+    def __init__(self, slots: int):
+        self._free = slots
+        self._waiting: "OrderedDict[str, deque]" = OrderedDict()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, tenant: str):
+        ticket = object()
+        with self._cond:
+            self._waiting.setdefault(tenant, deque()).append(ticket)
+            while not (self._free > 0 and self._next_ticket() is ticket):
+                self._cond.wait()
+
+            queue = self._waiting.pop(tenant)
+            queue.popleft()
+            if queue:
+                self._waiting[tenant] = queue  # Re-queued at the back
+            self._free -= 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._free += 1
+                self._cond.notify_all()
+
+    def _next_ticket(self):
+        for queue in self._waiting.values():
+            if queue:
+                return queue[0]
+        return None
+
+
 class SystemManager:
     def __init__(self):
         self.knowledge_manager = KnowledgeManager()
         self.video_manager = VideoManager("videos", "video_hash.txt")
         self.integration_loader = IntegrationLoader()
+        self.watcher = self.knowledge_manager.get_watcher()
+        self.watcher.subscribe("videos", self.video_manager.check_and_update_videos)
 
     def run_system(self):
         """Check updates in knowledge base and videos, then run integrations."""
         videos_updated = self.video_manager.check_and_update_videos()
+        self.watcher.start()
 
         if videos_updated:
             print("Updates detected. Running integrations...")
@@ -269,3 +1035,92 @@ class SystemManager:
                 module.run()
             except Exception as e:
                 print(f"Error running {module_name}: {e}")
+
+
+class MessageCoalescer:
+    """
+    Merge bursts of messages from the same chat into a single turn.
+    Every new message restarts the chat's window; when it expires the buffered
+    texts are joined and handed to on_flush(chat_id, prompt, generation).
+    A message arriving while a turn is still running folds that turn's text
+    into the next one and calls on_cancel(chat_id) so the stale run can stop,
+    until the turn commit()s its answer.
+    """
+
+    def __init__(
+        self,
+        on_flush: Callable[[str, str, int], None],
+        on_cancel: Optional[Callable[[str], None]] = None,
+        window: float = 1.5,
+    ):
+        self.on_flush = on_flush
+        self.on_cancel = on_cancel
+        self.window = window
+        self._lock = threading.Lock()
+        self._pending: Dict[str, List[str]] = {}
+        self._in_flight: Dict[str, List[str]] = {}
+        self._timers: Dict[str, threading.Timer] = {}
+        self._generation: Dict[str, int] = {}
+
+    def add(self, chat_id: str, text: str):
+        """Buffer a message and (re)start the chat's coalescing window."""
+        superseded = False
+        with self._lock:
+            pending = self._pending.setdefault(chat_id, [])
+            if chat_id in self._in_flight:
+                # Fold the running turn into the new one and invalidate it
+                pending[:0] = self._in_flight.pop(chat_id)
+                self._generation[chat_id] = self._generation.get(chat_id, 0) + 1
+                superseded = True
+            pending.append(text)
+
+            timer = self._timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            timer = threading.Timer(self.window, self._flush, args=(chat_id,))
+            timer.daemon = True
+            self._timers[chat_id] = timer
+            timer.start()
+
+        if superseded and self.on_cancel:
+            try:
+                self.on_cancel(chat_id)
+            except Exception as e:
+                logger.warning(f"Failed to cancel pending turn for {chat_id}: {e}")
+
+    def is_current(self, chat_id: str, generation: int) -> bool:
+        """True if no newer turn has been started for the chat."""
+        with self._lock:
+            return self._generation.get(chat_id) == generation
+
+    def commit(self, chat_id: str, generation: int) -> bool:
+        """
+        Claim the turn's answer for delivery: if the turn is still current its
+        text is no longer folded into later messages. False if superseded.
+        """
+        with self._lock:
+            if self._generation.get(chat_id) != generation:
+                return False
+            self._in_flight.pop(chat_id, None)
+            return True
+
+    def done(self, chat_id: str, generation: int):
+        """Mark a flushed turn as finished."""
+        with self._lock:
+            if self._generation.get(chat_id) == generation:
+                self._in_flight.pop(chat_id, None)
+
+    def _flush(self, chat_id: str):
+        with self._lock:
+            self._timers.pop(chat_id, None)
+            parts = self._pending.pop(chat_id, [])
+            if not parts:
+                return
+            self._in_flight[chat_id] = parts
+            generation = self._generation.get(chat_id, 0) + 1
+            self._generation[chat_id] = generation
+
+        try:
+            self.on_flush(chat_id, "\n".join(parts), generation)
+        finally:
+            self.done(chat_id, generation)
@@ -1,63 +1,392 @@
 import time
+import threading
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import telebot
-from ai_assistant.openai_service import AIAssistant
-from ai_assistant.views import get_chat_mapping, update_chat_mapping
+from telebot.apihelper import ApiTelegramException
+from ai_assistant.openai_service import AIAssistant, TokenBudgetExceeded
+from core_functions import (
+    FairLimiter,
+    MessageCoalescer,
+    load_tenant_configs,
+    start_knowledge_watchers,
+)
+from ai_assistant.views import enqueue_job
 import os
-from openai import OpenAI
 import logging
 
 # Set up logging for debugging purposes
 logger = logging.getLogger(__name__)
 
-client = OpenAI()
-bot = telebot.TeleBot(os.getenv("TELEGRAM_BOT_TOKEN"))
-ai_assistant = AIAssistant(api_key=os.getenv("OPENAI_API_KEY"))
+# With WORK_QUEUE=1 this process only takes messages in and `run_worker`
+# processes answer them from the database queue
+USE_WORK_QUEUE = os.getenv("WORK_QUEUE", "0") == "1"
 
+MAX_MESSAGE_LENGTH = 4096
 
-@bot.message_handler(commands=["start"])
-def send_welcome(message):
-    """Handles the /start command by initializing the chat thread."""
-    print("Received /start command.")
 
-    bot.reply_to(message, "Hey, I'm your AI Assistant, tell me your question?")
+def split_message(text, limit=MAX_MESSAGE_LENGTH):
+    """Splits text under Telegram's limit at paragraph, line or word breaks."""
+    chunks = []
+    while len(text) > limit:
+        cut = -1
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, 0, limit)
+            if cut > 0:
+                break
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
 
 
-@bot.message_handler(func=lambda message: True)
-def handle_message(message):
-    """Processes user messages and interacts with the AI assistant."""
-    print(f"Received user message: {message.text}")
-    chat_id = message.chat.id
-    user_input = message.text
+class TokenBucket:
+    """Refills `rate` tokens per second up to `capacity`."""
 
-    # Notify the user that the assistant is processing the request
-    processing_msg = bot.send_message(chat_id, "🤖 Thinking...")
-    print(f"Sent 'thinking' message: {processing_msg.message_id}")
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
 
-    # Call the AIAssistant's get_response method
-    print(f"Sending user input to assistant: {user_input}")
-    response = ai_assistant.get_response(
-        integration="telegram", chat_id=chat_id, prompt=user_input
-    )
+    def _refill(self, now):
+        # `now` may predate a bucket created after the caller read the clock
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
 
-    if response:
-        print(f"Sending assistant response: {response}")
-        bot.send_message(
-            chat_id,
-            response.value,
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundOp:
+    """A queued send or delete; gets `message_id` on success, `error` on failure."""
+
+    def __init__(self, kind, chat_id, text=None, target=None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.text = text
+        self.target = target
+        self.message_id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class SendQueue:
+    """
+    Outbound Telegram queue honouring the global (~30/s) and per-chat (~1/s)
+    flood limits. Operations of one chat run in order, one at a time; different
+    chats are served round-robin by a small pool so callers never block on the
+    Bot API. A 429 puts the op back and pauses that chat for `retry_after`.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1.0, executor=None):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self._global = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        self._queues = OrderedDict()
+        self._busy = set()
+        self._blocked_until = {}
+        self._cond = threading.Condition()
+        self._executor = executor or ThreadPoolExecutor(
+            8, thread_name_prefix="telegram-send"
+        )
+        threading.Thread(
+            target=self._dispatch, name="telegram-dispatch", daemon=True
+        ).start()
+
+    def send(self, chat_id, text):
+        """Queues text (split if too long) and returns the op of the last chunk."""
+        op = None
+        for chunk in split_message(text):
+            op = self._enqueue(OutboundOp("send", chat_id, text=chunk))
+        return op
+
+    def delete(self, op):
+        """Deletes a sent message, or drops the send if it has not gone out yet."""
+        with self._cond:
+            queue = self._queues.get(op.chat_id)
+            if queue and op in queue:
+                queue.remove(op)
+                op.done.set()
+                return None
+        return self._enqueue(OutboundOp("delete", op.chat_id, target=op))
+
+    def _enqueue(self, op):
+        with self._cond:
+            self._queues.setdefault(op.chat_id, deque()).append(op)
+            self._cond.notify()
+        return op
+
+    def _next_op(self):
+        """Returns (op, None) for a ready op or (None, seconds to wait)."""
+        now = time.monotonic()
+        wait = None
+        for chat_id in list(self._queues):
+            queue = self._queues[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+                continue
+            if chat_id in self._busy:
+                continue
+
+            blocked = self._blocked_until.get(chat_id, 0) - now
+            if blocked > 0:
+                wait = blocked if wait is None else min(wait, blocked)
+                continue
+            self._blocked_until.pop(chat_id, None)
+
+            op = queue[0]
+            bucket = None
+            if op.kind == "send":
+                bucket = self._chat_buckets.setdefault(
+                    chat_id, TokenBucket(self.chat_rate, 1)
+                )
+                delay = bucket.delay(now)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+
+            delay = self._global.delay(now)
+            if delay > 0:
+                return None, delay
+
+            self._global.take(now)
+            if bucket:
+                bucket.take(now)
+            queue.popleft()
+            self._busy.add(chat_id)
+            # Round-robin: the served chat goes to the back of the line
+            self._queues.move_to_end(chat_id)
+            return op, None
+        return None, wait
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                op, wait = self._next_op()
+                if op is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+            self._executor.submit(self._execute, op)
+
+    def _execute(self, op):
+        try:
+            if op.kind == "send":
+                op.message_id = self.bot.send_message(op.chat_id, op.text).message_id
+            elif op.target.message_id is not None:
+                self.bot.delete_message(op.chat_id, op.target.message_id)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = (e.result_json or {}).get("parameters", {}).get(
+                    "retry_after", 1
+                )
+                logger.warning(
+                    f"Flood limit for chat {op.chat_id}, retry in {retry_after}s"
+                )
+                with self._cond:
+                    self._queues.setdefault(op.chat_id, deque()).appendleft(op)
+                    self._blocked_until[op.chat_id] = time.monotonic() + retry_after
+                    self._busy.discard(op.chat_id)
+                    self._cond.notify()
+                return
+            logger.error(f"Telegram {op.kind} failed for chat {op.chat_id}: {e}")
+            op.error = e
+        except Exception as e:
+            logger.error(f"Telegram {op.kind} failed for chat {op.chat_id}: {e}")
+            op.error = e
+
+        op.done.set()
+        with self._cond:
+            self._busy.discard(op.chat_id)
+            self._cond.notify()
+
+
+# Telegram's global limit applies per bot token across all processes, but
+# every process keeps its own bucket. With WORK_QUEUE=1 the replies are sent
+# by the run_worker processes, so set TELEGRAM_SEND_PROCESSES to the number
+# of workers and the budget is split evenly between them.
+SEND_PROCESSES = max(int(os.getenv("TELEGRAM_SEND_PROCESSES", "1")), 1)
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) / SEND_PROCESSES
+
+# Shared by every tenant: Bot API send threads and concurrent turn slots
+send_executor = ThreadPoolExecutor(
+    int(os.getenv("TELEGRAM_SEND_WORKERS", "8")), thread_name_prefix="telegram-send"
+)
+turn_limiter = FairLimiter(int(os.getenv("MAX_CONCURRENT_TURNS", "16")))
+
+
+class TelegramTenant:
+    """One school's bot with its own assistant, caches and flood limits."""
+
+    def __init__(self, config, owns_knowledge=True):
+        self.name = config.name
+        self.integration = config.integration("telegram")
+        self.bot = telebot.TeleBot(config.bot_token)
+        self.ai_assistant = AIAssistant(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            assistant_name=config.assistant_name,
+            vector_store_name=config.vector_store_name,
+            knowledge_manager=config.knowledge_manager(),
+            owns_knowledge=owns_knowledge,
+        )
+        # Flood limits are per bot token, the send threads are shared
+        self.send_queue = SendQueue(
+            self.bot,
+            global_rate=GLOBAL_RATE,
+            chat_rate=float(os.getenv("TELEGRAM_CHAT_RATE", "1")),
+            executor=send_executor,
         )
-    else:
-        print("Sending error message: Unable to retrieve response from AI.")
-        bot.send_message(
-            chat_id,
-            "Error: Could not get a response from AI.",
+        # With WORK_QUEUE=1 the runs live in the run_worker processes, so
+        # on_cancel finds nothing to cancel here; a message that arrives
+        # before a worker claims the job is folded into it by enqueue_job()
+        self.coalescer = MessageCoalescer(
+            on_flush=self.process_turn,
+            on_cancel=lambda chat_id: self.ai_assistant.cancel_run(
+                self.integration, chat_id
+            ),
+            window=float(os.getenv("MESSAGE_COALESCE_WINDOW", "1.5")),
         )
+        # Serialises turns per chat so a folded turn waits for the cancelled one
+        self.chat_locks = defaultdict(threading.Lock)
+
+        self.bot.message_handler(commands=["start"])(self.send_welcome)
+        self.bot.message_handler(func=lambda message: True)(self.handle_message)
+
+    def send_welcome(self, message):
+        """Handles the /start command by initializing the chat thread."""
+        print("Received /start command.")
+
+        self.bot.reply_to(
+            message, "Hey, I'm your AI Assistant, tell me your question?"
+        )
+
+    def handle_message(self, message):
+        """Buffers user messages so bursts from one chat become a single turn."""
+        print(f"[{self.name}] Received user message: {message.text}")
+        self.coalescer.add(message.chat.id, message.text)
+
+    def answer_turn(self, chat_id, user_input, commit=lambda: True):
+        """
+        Gets the assistant's answer for one turn and queues the reply.
+        commit() is called before replying and returns False if the turn was
+        superseded by a newer message.
+        """
+        # Notify the user that the assistant is processing the request
+        processing_msg = self.send_queue.send(chat_id, "🤖 Thinking...")
+        print("Queued 'thinking' message")
+
+        try:
+            # Call the AIAssistant's get_response method
+            print(f"Sending user input to assistant: {user_input}")
+            try:
+                with turn_limiter.slot(self.name):
+                    response = self.ai_assistant.get_response(
+                        integration=self.integration, chat_id=chat_id, prompt=user_input
+                    )
+            except TokenBudgetExceeded as e:
+                print(f"Throttling chat {chat_id}: {e}")
+                return self.send_queue.send(
+                    chat_id,
+                    "You have reached today's question limit, please try again tomorrow.",
+                )
+
+            if not commit():
+                print(f"Dropping answer of superseded turn for chat {chat_id}")
+            elif response:
+                print(f"Sending assistant response: {response}")
+                return self.send_queue.send(
+                    chat_id,
+                    response,
+                )
+            else:
+                print("Sending error message: Unable to retrieve response from AI.")
+                return self.send_queue.send(
+                    chat_id,
+                    "Error: Could not get a response from AI.",
+                )
+        finally:
+            # Delete the 'thinking' message, or drop it if it is still queued
+            print("Deleting 'thinking' message")
+            self.send_queue.delete(processing_msg)
+
+    def process_turn(self, chat_id, user_input, generation):
+        """Answers one coalesced turn inline, or hands it to the work queue."""
+        with self.chat_locks[chat_id]:
+            if not self.coalescer.is_current(chat_id, generation):
+                print(f"Skipping superseded turn for chat {chat_id}")
+                return
+
+            if USE_WORK_QUEUE:
+                job = enqueue_job(self.integration, chat_id, user_input)
+                print(f"Queued job {job.pk} for chat {chat_id}")
+                return
+
+            self.answer_turn(
+                chat_id,
+                user_input,
+                lambda: self.coalescer.commit(chat_id, generation),
+            )
+
+
+_tenants = None
+_tenants_lock = threading.Lock()
+
+
+def get_tenants(owns_knowledge=True):
+    """
+    Builds the bots and assistants of all tenants on first use. Only the
+    intake process owns the knowledge: it compiles and uploads it, while
+    queue workers pass owns_knowledge=False and just reload their caches.
+    """
+    global _tenants
+    with _tenants_lock:
+        if _tenants is None:
+            _tenants = {
+                tenant.integration: tenant
+                for tenant in (
+                    TelegramTenant(config, owns_knowledge)
+                    for config in load_tenant_configs()
+                )
+            }
+            start_knowledge_watchers()
+        return _tenants
+
 
-    # Delete the 'thinking' message
-    print(f"Deleting 'thinking' message with ID: {processing_msg.message_id}")
-    bot.delete_message(chat_id, processing_msg.message_id)
+def process_job(job):
+    """Entry point for queue workers: answers a claimed job."""
+    tenant = get_tenants(owns_knowledge=False)[job.integration]
+    reply = tenant.answer_turn(job.chat_id, job.prompt)
+    # Acknowledge only once Telegram accepted the reply
+    if reply and not reply.done.wait(timeout=60):
+        raise TimeoutError(f"Reply for job {job.pk} was not delivered in time")
+    if reply and reply.error:
+        raise RuntimeError(f"Reply for job {job.pk} failed: {reply.error}")
 
 
 def run():
-    """Runs the Telegram bot."""
-    print("Telegram bot is running...")
-    bot.polling(none_stop=True)
+    """Runs the Telegram bots of all tenants in this process."""
+    tenants = get_tenants(owns_knowledge=True)
+    # Upload pending knowledge changes now; with WORK_QUEUE=1 this process
+    # never answers a turn itself
+    for tenant in tenants.values():
+        tenant.ai_assistant.sync_knowledge()
+    bots = [tenant.bot for tenant in tenants.values()]
+    for bot in bots[1:]:
+        threading.Thread(
+            target=bot.polling, kwargs={"none_stop": True}, daemon=True
+        ).start()
+    print(f"Telegram bot is running for {len(bots)} tenant(s)...")
+    bots[0].polling(none_stop=True)